@@ -0,0 +1,257 @@
+import math
+import time
+from enum import Enum
+
+import numpy as np
+
+
+"""
+Table driven threshold alarms.
+
+Every channel (a variable of a sensor) has a row of limits
+(min, max, hysteresis) and a row of state (low alarm, high alarm).
+All channels are evaluated at once with array operations, so the cost
+per sample does not grow much with the number of sensors.
+
+An alarm is raised when the value goes below min or above max and
+cleared when it comes back past min + hysteresis or max - hysteresis.
+
+Usage:
+
+    table = AlarmTable(['temperature', 'humidity'])
+    table.set_limits({'temperature': (1, 6, 1), 'humidity': (0, 90, 2)})
+    for channel, type in table.evaluate({'temperature': 7.2}):
+        print(channel, type)  # temperature ALARM_TYPE.HIGH
+
+AlarmDigest debounces the resulting events and merges them into digest
+messages with a rate limit per number:
+
+    digest = AlarmDigest(dwell=60, min_interval=300)
+    digest.add('temperature', ALARM_TYPE.HIGH, 7.2)
+    for number, events in digest.due(['+358...']):
+        ...  # events: [(channel, type, value, since)]
+"""
+
+
+class ALARM_TYPE(Enum):
+    LOW = 1
+    HIGH = 2
+    NORMAL = 3
+
+
+class AlarmTable:
+    def __init__(self, channels, variables=None):
+        """
+        'channels' are the channel names. 'variables' gives the threshold
+        profile variable of each channel, by default the channel name.
+        """
+        self.channels = list(channels)
+        self.variables = list(variables or channels)
+        self._rows = {channel: i for i, channel in enumerate(self.channels)}
+
+        # (min, max, hysteresis) of each channel, NaN: no limits
+        self.limits = np.full((len(self.channels), 3), np.nan)
+        # (low alarm, high alarm) of each channel
+        self.state = np.zeros((len(self.channels), 2), dtype=bool)
+
+    def set_limits(self, thresholds):
+        """
+        Sets the limits of every channel from 'thresholds'
+        {variable: (min, max, hysteresis)}.
+        """
+        for i, variable in enumerate(self.variables):
+            self.limits[i] = thresholds.get(variable, (np.nan,) * 3)
+
+    def _values(self, values):
+        # {channel: value} -> array in channel order, NaN if missing
+        array = np.full(len(self.channels), np.nan)
+        for channel, value in values.items():
+            if channel in self._rows and value is not None:
+                array[self._rows[channel]] = value
+        return array
+
+    def _events(self, low, high, normal):
+        events = []
+        for i in np.flatnonzero(low | high | normal):
+            channel = self.channels[i]
+            if low[i]:
+                events.append((channel, ALARM_TYPE.LOW))
+            if high[i]:
+                events.append((channel, ALARM_TYPE.HIGH))
+            if normal[i]:
+                events.append((channel, ALARM_TYPE.NORMAL))
+        return events
+
+    def evaluate(self, values):
+        """
+        Updates the state with the measured 'values' {channel: value} and
+        returns the alarm events [(channel, ALARM_TYPE)]. Channels without
+        a value keep their state.
+        """
+        v = self._values(values)
+        low_limit, high_limit, hysteresis = self.limits.T
+        low, high = self.state[:, 0].copy(), self.state[:, 1].copy()
+
+        raise_low = (v < low_limit) & ~low
+        raise_high = (v > high_limit) & ~high
+        low |= raise_low
+        high |= raise_high
+
+        # At most one alarm of a channel is cleared per sample.
+        # Back to normal is reported only if the other one is not on.
+        clear_low = (v > low_limit + hysteresis) & low
+        clear_high = (v < high_limit - hysteresis) & high & ~clear_low
+        normal = (clear_low & ~high) | (clear_high & ~low)
+        low &= ~clear_low
+        high &= ~clear_high
+
+        self.state[:, 0] = low
+        self.state[:, 1] = high
+        return self._events(raise_low, raise_high, normal)
+
+    def clear(self, values):
+        """
+        Clears the alarms of the channels whose value in 'values' is back
+        inside the limits, ignoring the hysteresis. Returns the events.
+        """
+        v = self._values(values)
+        low_limit, high_limit, _ = self.limits.T
+        low, high = self.state[:, 0], self.state[:, 1]
+
+        clear_low = (v > low_limit) & low
+        clear_high = (v < high_limit) & high & ~clear_low
+        low &= ~clear_low
+        high &= ~clear_high
+        return self._events(np.zeros_like(low), np.zeros_like(high),
+                            clear_low | clear_high)
+
+    def get_state(self):
+        """
+        Returns {channel: [low alarm, high alarm]}.
+        """
+        return {channel: [bool(low), bool(high)]
+                for channel, (low, high) in zip(self.channels, self.state)}
+
+    def load_state(self, state):
+        """
+        Restores the state returned by get_state. Unknown channels are
+        ignored.
+        """
+        for channel, (low, high) in state.items():
+            if channel in self._rows:
+                self.state[self._rows[channel]] = (low, high)
+
+
+class AlarmDigest:
+    """
+    Debouncing and rate limiting of alarm messages.
+
+    A transition is reported only after it has lasted 'dwell' seconds.
+    A channel that returns to its reported state within the dwell time
+    is not reported at all. Transitions that become due together are
+    merged into one digest, and each number gets at most one digest per
+    'min_interval' seconds. Transitions held back by that limit are
+    added to the number's next digest.
+    """
+
+    def __init__(self, dwell=0, min_interval=0):
+        self.dwell = dwell
+        self.min_interval = min_interval
+
+        # channel -> [type, value, since, type before the transition]
+        self._pending = {}
+        # channel -> last reported type
+        self._reported = {}
+        # number -> [(channel, type, value, since)] waiting for the limit
+        self._held = {}
+        # number -> time of the previous digest
+        self._last_sent = {}
+
+    def add(self, channel, type, value=None, now=None):
+        now = time.time() if now is None else now
+        pending = self._pending.get(channel)
+        if pending is None:
+            origin = self._reported.get(
+                channel, ALARM_TYPE.NORMAL if type != ALARM_TYPE.NORMAL
+                else None)
+            self._pending[channel] = [type, value, now, origin]
+        elif type == pending[3]:
+            # Back to the reported state before the dwell time
+            del self._pending[channel]
+        else:
+            pending[:3] = [type, value, now]
+
+    def next_due(self):
+        """
+        Returns the time when due() has something to return next,
+        None if nothing is waiting.
+        """
+        times = [since + self.dwell for _, _, since, _
+                 in self._pending.values()]
+        times += [self._last_sent.get(number, -math.inf) + self.min_interval
+                  for number, events in self._held.items() if events]
+        return min(times) if times else None
+
+    def due(self, numbers, now=None):
+        """
+        Returns the digests [(number, [(channel, type, value, since)])]
+        to send now to 'numbers'.
+        """
+        now = time.time() if now is None else now
+
+        events = []
+        for channel, (type, value, since, _) in list(self._pending.items()):
+            if now >= since + self.dwell:
+                del self._pending[channel]
+                self._reported[channel] = type
+                events.append((channel, type, value, since))
+
+        digests = []
+        for number in numbers:
+            held = self._held.setdefault(number, [])
+            held += events
+            if held and now >= self._last_sent.get(number, -math.inf) + \
+                    self.min_interval:
+                digests.append((number, held))
+                self._held[number] = []
+                self._last_sent[number] = now
+
+        for number in set(self._held) - set(numbers):
+            del self._held[number]
+        return digests
+
+    def get_state(self):
+        """
+        Returns the transitions not yet sent as a JSON compatible dict,
+        so that a restart within the dwell time or the rate limit does
+        not lose them.
+        """
+        def name(type):
+            return type.name if type is not None else None
+
+        return {'pending': {channel: [name(type), value, since, name(origin)]
+                            for channel, (type, value, since, origin)
+                            in self._pending.items()},
+                'reported': {channel: name(type)
+                             for channel, type in self._reported.items()},
+                'held': {number: [[channel, name(type), value, since]
+                                  for channel, type, value, since in events]
+                         for number, events in self._held.items() if events},
+                'last_sent': dict(self._last_sent)}
+
+    def load_state(self, state):
+        """
+        Restores the state returned by get_state.
+        """
+        def type(name):
+            return ALARM_TYPE[name] if name is not None else None
+
+        self._pending = {channel: [type(t), value, since, type(origin)]
+                         for channel, (t, value, since, origin)
+                         in state.get('pending', {}).items()}
+        self._reported = {channel: type(t) for channel, t
+                          in state.get('reported', {}).items()}
+        self._held = {number: [(channel, type(t), value, since)
+                               for channel, t, value, since in events]
+                      for number, events in state.get('held', {}).items()}
+        self._last_sent = dict(state.get('last_sent', {}))
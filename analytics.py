@@ -0,0 +1,281 @@
+import os
+import re
+import sys
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+
+import numpy as np
+
+from binary_log import BinaryLog, HEADER, RECORD_DTYPE
+from compression import open_log, uncompressed_name
+
+
+"""
+Shipment quality analytics over the log files.
+
+The log files (text, binary, compressed or not) are loaded into numpy
+arrays and all metrics are computed with array operations:
+
+    - time below and above the threshold range
+    - excursions with the same hysteresis as the alarms: count and durations
+    - mean kinetic temperature
+    - statistics of both variables
+
+Each sample is taken to represent the time until the next sample. A sample
+followed by a gap longer than MAX_GAP_FACTOR times the median interval
+(logger off) represents only the median interval, the rest of the gap is
+not counted. Means and standard deviations are weighted by these
+durations.
+
+Usage:
+
+    data = load_logs(['log_data/20221030_121212.txt'])
+    report = analyze(data, logger.get_thresholds())
+    print(report.mean_kinetic_temperature, report.temperature.time_above)
+
+    python analytics.py threshold_profiles/milk.ini log_data/*.txt*
+"""
+
+
+# Activation energy / gas constant used for mean kinetic temperature (K)
+MKT_ACTIVATION = 83.144e3 / 8.3144
+
+MAX_GAP_FACTOR = 3
+
+VARIABLES = ('temperature', 'humidity')
+
+_NUMBER = rb'[-+]?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?'
+# A complete text log record: YYYYmmdd_HHMMSS<TAB>temperature<TAB>humidity
+_TEXT_RECORD = re.compile(rb'\d{8}_\d{6}\t' + _NUMBER + rb'\t' + _NUMBER +
+                          rb'\r?\n')
+_TEXT_DTYPE = [('time', 'S15'), ('temperature', 'f8'), ('humidity', 'f8')]
+
+
+def _local_to_epoch(naive):
+    """
+    Converts local wall clock seconds (as if UTC) to epoch seconds.
+    The UTC offset is looked up once per distinct hour.
+    """
+    hours, inverse = np.unique(naive // 3600, return_inverse=True)
+    offsets = np.array([
+        datetime.fromtimestamp(int(h) * 3600, timezone.utc)
+        .replace(tzinfo=None).timestamp() - int(h) * 3600
+        for h in hours])
+    return naive + offsets[inverse]
+
+
+def _load_text(f):
+    f.readline()  # Header
+    # Malformed lines, for example one cut by a crash or still being
+    # written, are skipped like in compression.iter_records
+    lines = [line.decode() for line in f if _TEXT_RECORD.fullmatch(line)]
+    if lines:
+        records = np.loadtxt(lines, ndmin=1, dtype=_TEXT_DTYPE)
+    else:
+        records = np.zeros(0, dtype=_TEXT_DTYPE)
+
+    # YYYYmmdd_HHMMSS -> digits
+    digits = np.ascontiguousarray(records['time']).view(np.uint8) \
+        .reshape(-1, 15).astype(np.int64) - ord('0')
+
+    def number(first, last):
+        value = np.zeros(len(digits), dtype=np.int64)
+        for i in range(first, last):
+            value = value * 10 + digits[:, i]
+        return value
+
+    days = (number(0, 4) - 1970).astype('M8[Y]').astype('M8[M]') + \
+        (number(4, 6) - 1)
+    days = days.astype('M8[D]') + (number(6, 8) - 1)
+    naive = days.astype(np.int64) * 86400 + number(9, 11) * 3600 + \
+        number(11, 13) * 60 + number(13, 15)
+
+    return {'time': _local_to_epoch(naive.astype(np.float64)),
+            'temperature': records['temperature'],
+            'humidity': records['humidity']}
+
+
+def _load_binary(fpath):
+    if fpath.endswith('.gz'):
+        with open_log(fpath) as f:
+            f.read(HEADER.size)
+            data = f.read()
+        count = len(data) // RECORD_DTYPE.itemsize
+        records = np.frombuffer(data, dtype=RECORD_DTYPE, count=count)
+    else:
+        with BinaryLog(fpath) as log:
+            records = log.records.copy()
+
+    return {'time': records['time'].astype(np.float64),
+            'temperature': records['temperature'].astype(np.float64),
+            'humidity': records['humidity'].astype(np.float64)}
+
+
+def load_log(fpath, start=None, end=None):
+    """
+    Loads a log file into {'time', 'temperature', 'humidity'} arrays,
+    optionally only the records between the epoch times 'start' and 'end'.
+    """
+    if uncompressed_name(fpath).endswith('.bin'):
+        data = _load_binary(fpath)
+    else:
+        with open_log(fpath) as f:
+            data = _load_text(f)
+
+    times = data['time']
+    lo = 0 if start is None else np.searchsorted(times, start, side='left')
+    hi = len(times) if end is None else np.searchsorted(times, end, side='right')
+    return {key: values[lo:hi] for key, values in data.items()}
+
+
+def load_logs(fpaths, start=None, end=None):
+    """
+    Loads and concatenates several log files in time order.
+    """
+    parts = [load_log(fpath, start, end) for fpath in fpaths]
+    data = {key: np.concatenate([p[key] for p in parts]) if parts
+            else np.empty(0) for key in ('time',) + VARIABLES}
+
+    order = np.argsort(data['time'], kind='stable')
+    return {key: values[order] for key, values in data.items()}
+
+
+def sample_durations(times):
+    """
+    Seconds represented by each sample, the median interval for the last
+    sample and for a sample followed by a long gap.
+    """
+    if len(times) < 2:
+        return np.zeros(len(times))
+
+    intervals = np.diff(times)
+    median = np.median(intervals)
+    durations = np.append(intervals, median)
+    durations[durations > MAX_GAP_FACTOR * median] = median
+    return durations
+
+
+def hysteresis_state(enter, leave):
+    """
+    Alarm state of each sample: True from a sample where 'enter' is True
+    until the next sample where 'leave' is True.
+    """
+    events = np.where(enter | leave, np.arange(len(enter)), -1)
+    last_event = np.maximum.accumulate(events) if len(events) else events
+    return np.where(last_event >= 0, enter[np.maximum(last_event, 0)], False)
+
+
+def runs(state, durations):
+    """
+    Returns the durations of the consecutive True runs in 'state'.
+    """
+    edges = np.diff(np.concatenate(([0], state.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    cumulative = np.concatenate(([0.0], np.cumsum(durations)))
+    return cumulative[ends] - cumulative[starts]
+
+
+def mean_kinetic_temperature(temperatures, weights):
+    """
+    Mean kinetic temperature in Celsius of the temperatures in Celsius.
+    """
+    kelvin = temperatures + 273.15
+    mean = np.average(np.exp(-MKT_ACTIVATION / kelvin), weights=weights)
+    return MKT_ACTIVATION / -np.log(mean) - 273.15
+
+
+@dataclass
+class VariableReport:
+    minimum: float
+    maximum: float
+    mean: float
+    std: float
+    time_below: float  # seconds below min
+    time_above: float  # seconds above max
+    low_excursions: np.ndarray = field(repr=False)  # durations in seconds
+    high_excursions: np.ndarray = field(repr=False)
+
+    @property
+    def low_count(self):
+        return len(self.low_excursions)
+
+    @property
+    def high_count(self):
+        return len(self.high_excursions)
+
+
+@dataclass
+class ShipmentReport:
+    samples: int
+    duration: float  # seconds
+    mean_kinetic_temperature: float
+    temperature: VariableReport
+    humidity: VariableReport
+
+
+def analyze_variable(values, durations, threshold):
+    """
+    'threshold' is the (min, max, hysteresis) tuple of a threshold profile.
+    """
+    low, high, hysteresis = threshold
+    low_state = hysteresis_state(values < low, values > low + hysteresis)
+    high_state = hysteresis_state(values > high, values < high - hysteresis)
+
+    mean = np.average(values, weights=durations)
+    variance = np.average((values - mean) ** 2, weights=durations)
+
+    return VariableReport(
+        minimum=float(values.min()),
+        maximum=float(values.max()),
+        mean=float(mean),
+        std=float(np.sqrt(variance)),
+        time_below=float(durations[values < low].sum()),
+        time_above=float(durations[values > high].sum()),
+        low_excursions=runs(low_state, durations),
+        high_excursions=runs(high_state, durations))
+
+
+def analyze(data, thresholds):
+    """
+    Computes the quality metrics of loaded log data against 'thresholds'
+    as returned by DataLogger.get_thresholds. Returns None if there is
+    no data.
+    """
+    if not len(data['time']):
+        return None
+
+    durations = sample_durations(data['time'])
+    if not durations.any():
+        durations = np.ones(len(durations))
+
+    return ShipmentReport(
+        samples=len(data['time']),
+        duration=float(durations.sum()),
+        mean_kinetic_temperature=float(mean_kinetic_temperature(
+            data['temperature'], durations)),
+        **{variable: analyze_variable(data[variable], durations,
+                                      thresholds[variable])
+           for variable in VARIABLES})
+
+
+if __name__ == '__main__':
+    from profiles import load_profile
+
+    thresholds = load_profile(sys.argv[1])
+
+    report = analyze(load_logs(sys.argv[2:]), thresholds)
+    if report is None:
+        print('No data')
+        sys.exit(1)
+
+    print(f'{os.path.basename(sys.argv[1])}: {report.samples} samples, '
+          f'{report.duration / 3600:.1f} h')
+    print(f'mean kinetic temperature: {report.mean_kinetic_temperature:.2f}')
+    for variable in VARIABLES:
+        r = getattr(report, variable)
+        print(f'{variable}: {r.minimum:.2f} - {r.maximum:.2f}, '
+              f'mean {r.mean:.2f}, std {r.std:.2f}')
+        print(f'  below {r.time_below / 60:.0f} min in {r.low_count} excursions, '
+              f'above {r.time_above / 60:.0f} min in {r.high_count} excursions')
@@ -0,0 +1,113 @@
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from log_writer import LogWriter
+
+
+"""
+Fixed width binary log format.
+
+File layout:
+
+    header: magic b'FOTR', format version (uint16), record size (uint16),
+            8 reserved bytes
+    records: epoch seconds (uint32), temperature (float32),
+             humidity (float32), little endian
+
+A record is 12 bytes instead of about 30 for a line of the text log.
+
+Usage:
+
+    with BinaryLog('log_data/20221030_121212.bin') as log:
+        print(log.temperature.max(), log.time[-1])
+"""
+
+
+MAGIC = b'FOTR'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHH8x')
+RECORD = struct.Struct('<Iff')
+
+RECORD_DTYPE = np.dtype([('time', '<u4'),
+                         ('temperature', '<f4'),
+                         ('humidity', '<f4')])
+
+
+def pack_record(timestamp, temperature, humidity):
+    return RECORD.pack(int(timestamp), temperature, humidity)
+
+
+class BinaryLogWriter(LogWriter):
+    def __init__(self, fpath, append=False, **kwargs):
+        if append:
+            super().__init__(fpath, mode='ab', **kwargs)
+        else:
+            super().__init__(fpath, mode='wb',
+                             header=HEADER.pack(MAGIC, VERSION, RECORD.size),
+                             **kwargs)
+
+    # A record left partially written by a crash is removed
+    def _repair_tail(self, fpath):
+        with open(fpath, 'rb+') as f:
+            size = f.seek(0, os.SEEK_END)
+            f.truncate(size - (size - HEADER.size) % RECORD.size)
+
+    def write_sample(self, timestamp, temperature, humidity):
+        self.write(pack_record(timestamp, temperature, humidity))
+
+
+class BinaryLog:
+    """
+    Memory mapped reader for a binary log file.
+
+    The columns are numpy arrays viewing the mapped file without copying.
+    They are valid until close() is called. A partially written record
+    at the end of the file is ignored.
+    """
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        with open(fpath, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, record_size = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError(f'Not a binary log file: {fpath}')
+        if version != VERSION or record_size != RECORD_DTYPE.itemsize:
+            self._mmap.close()
+            raise ValueError(
+                f'Unsupported binary log version {version}: {fpath}')
+
+        count = (len(self._mmap) - HEADER.size) // record_size
+        self.records = np.frombuffer(self._mmap, dtype=RECORD_DTYPE,
+                                     count=count, offset=HEADER.size)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def time(self):
+        return self.records['time']
+
+    @property
+    def temperature(self):
+        return self.records['temperature']
+
+    @property
+    def humidity(self):
+        return self.records['humidity']
+
+    def close(self):
+        self.records = None
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,100 +1,445 @@
-from gsm import GSM
+import collections
+import concurrent.futures
+import configparser
+import os
+import threading
+import time
+
+from gsm import GSM, GSMError, InvalidNumberError
+from outbox import Outbox
+from sms_pdu import pack_message
 from tasks import TASK_TYPE
+import metrics
+
+
+# Outbound message priorities, the smallest is sent first
+PRIORITY_ALARM = 0
+PRIORITY_NOTICE = 1  # For example back in the normal range
+PRIORITY_REPLY = 2  # Replies to commands
+
+# Seconds after which an unsent reply is dropped
+REPLY_DEADLINE = 300
+
+
+class OutboundMessage:
+    """
+    Handle for a message queued with Communication.send_message.
+    """
+
+    def __init__(self, number, message, priority=PRIORITY_REPLY,
+                 deadline=None):
+        self.number = number
+        self.message = message
+        self.priority = priority
+        # time.time() after which the message is dropped, None: never
+        self.deadline = deadline
+        self.sent = False
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the worker has handled the message or until 'timeout'
+        seconds have passed. Returns True if the modem confirmed the message.
+        """
+        self._done.wait(timeout)
+        return self.sent
+
+    def done(self):
+        return self._done.is_set()
+
+    def _finish(self, sent):
+        self.sent = sent
+        self._done.set()
+
 
 class Communication:
-    def __init__(self):
-        self.gsm = GSM()
+    # Seconds between received message checks when there is nothing to send
+    POLL_INTERVAL = 5
+    # Seconds between full checks when new message notifications are used
+    SWEEP_INTERVAL = 600
+    # Longest time the worker waits for notifications before
+    # checking the outbound queue again
+    NOTIFY_WAIT = 0.5
+    # Messages taken from the outbox at a time
+    SEND_BATCH = 10
+    # Seconds the worker waits after an unexpected error, doubled for
+    # every error in a row
+    ERROR_BACKOFF = 5
+    MAX_ERROR_BACKOFF = 300
+
+    # 'gsm' replaces the modem, for example with
+    # GSM(ser=simulated_modem.SimulatedModem())
+    def __init__(self, gsm=None):
+        self.gsm = gsm or GSM()
+
+        # 'notify': react to new message notifications from the modem
+        # 'poll': list all stored messages every POLL_INTERVAL seconds
+        settings = configparser.ConfigParser()
+        settings.read('settings.ini')
+        self.inbound_mode = settings.get('DEFAULT', 'inbound_sms',
+                                         fallback='notify')
 
         self.tasks = []
+        self._tasks_lock = threading.Lock()
+        # Called without arguments when a task is added, from the worker
+        # thread
+        self.on_task = None
+
+        # The first check also picks up messages left
+        # on the SIM card by an earlier run
+        self._checked = False
+
+        # Outbound messages, stored on disk until the modem has sent them
+        # and drained by the worker thread which is the only user of the
+        # serial port after initialization. Messages left by an earlier
+        # run are sent first.
+        outbox_fpath = settings.get('DEFAULT', 'outbox_file',
+                                    fallback='./log_data/outbox.db')
+        os.makedirs(os.path.dirname(outbox_fpath) or '.', exist_ok=True)
+        self.outbox = Outbox(outbox_fpath)
+        # OutboundMessage handles of this run by outbox id
+        self._handles = {}
+        self._outbox_lock = threading.Lock()
+        # Other modem jobs (for example HTTP uploads), run by the worker
+        # when no message is due: [(func, future)]
+        self._jobs = collections.deque()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def _run(self):
+        notify = self.inbound_mode == 'notify'
+        if notify:
+            try:
+                self.gsm.enable_new_message_indications()
+            except Exception as e:
+                print('enabling message notifications failed:', e)
+                notify = False
+
+        # With notifications the full check is only a safety net for
+        # messages received while not running or lost notifications
+        self._poll_interval = self.SWEEP_INTERVAL if notify \
+            else self.POLL_INTERVAL
+        self._next_poll = 0
+        backoff = self.ERROR_BACKOFF
+        while True:
+            # An error (for example a lost serial port or a database
+            # error) must not stop sending and receiving for good
+            try:
+                if self._run_once(notify):
+                    return
+                backoff = self.ERROR_BACKOFF
+            except Exception as e:
+                print('communication worker failed:', e)
+                metrics.inc('communication_errors_total')
+                if self._stopping:
+                    return
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.MAX_ERROR_BACKOFF)
+
+    # One pass of the worker loop, returns True when stopped
+    def _run_once(self, notify):
+        if time.monotonic() >= self._next_poll:
+            self.check_recieved_messages()
+            self._next_poll = time.monotonic() + self._poll_interval
+
+        timeout = max(0, self._next_poll - time.monotonic())
+        self._wakeup.clear()
+        batch = self._due_messages()
+        if notify:
+            # Wait on the serial port while there is nothing to send
+            self.check_new_messages(
+                0 if batch else min(timeout, self.NOTIFY_WAIT))
+            timeout = 0
+
+        if not batch and self._jobs and not self._stopping:
+            self._run_job(*self._jobs.popleft())
+            return False
+
+        if not batch:
+            if self._stopping:
+                return True
+            retry = self.outbox.next_attempt()
+            if retry is not None:
+                timeout = min(timeout, max(0, retry - time.time()))
+            self._wakeup.wait(timeout)
+            return False
+
+        for mid, number, message, attempts in batch:
+            sent = self._send(number, message)
+            if sent is None:
+                # Can never be sent, dropped instead of retried
+                self.outbox.ack(mid)
+                self._finish(mid, False)
+            elif sent:
+                self.outbox.ack(mid)
+                self._finish(mid, True)
+            else:
+                self.outbox.retry(mid, attempts)
+
+            # A new message may have a higher priority
+            if self._wakeup.is_set():
+                break
+        return False
+
+    # Messages to send now, drops the ones past their deadline
+    def _due_messages(self):
+        now = time.time()
+        dropped = self.outbox.drop_expired(now)
+        if dropped:
+            print('dropped stale messages:', dropped)
+            metrics.inc('sms_dropped_total', dropped)
+            with self._outbox_lock:
+                expired = [mid for mid, msg in self._handles.items()
+                           if msg.deadline is not None and msg.deadline < now]
+            for mid in expired:
+                self._finish(mid, False)
+        return self.outbox.due(self.SEND_BATCH, now)
+
+    def _run_job(self, func, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(self.gsm))
+        except BaseException as e:
+            future.set_exception(e)
 
+    def run_on_modem(self, func):
+        """
+        Calls func(gsm) in the worker thread between messages and returns
+        a concurrent.futures.Future of its result. Messages due to be sent
+        go first, so a long job delays an alarm by at most its own length.
+        """
+        future = concurrent.futures.Future()
+        if self._stopping:
+            future.set_exception(GSMError('communication stopped'))
+            return future
+        self._jobs.append((func, future))
+        self._wakeup.set()
+        return future
+
+    def _finish(self, mid, sent):
+        with self._outbox_lock:
+            msg = self._handles.pop(mid, None)
+        if msg is not None:
+            msg._finish(sent)
+
+    def stop(self, timeout=None):
+        """
+        Stops the worker after the queued messages which can be sent now
+        have been sent. Messages waiting for a retry stay in the outbox.
+        """
+        self._stopping = True
+        self._wakeup.set()
+        self._worker.join(timeout)
+        while self._jobs:
+            _, future = self._jobs.popleft()
+            if future.set_running_or_notify_cancel():
+                future.set_exception(GSMError('communication stopped'))
+
+    # 'logger' is the container the command is meant for in fleet mode
+    def _add_task(self, task, logger=None):
+        task['data']['logger'] = logger
+        with self._tasks_lock:
+            self.tasks.append(task)
+        if self.on_task is not None:
+            self.on_task()
+
+    # Runs in the worker thread. Only unread messages are fetched after the
+    # first check and exactly the handled messages are deleted
     def check_recieved_messages(self):
-        messages = self.gsm.get_messages()
-        self.gsm.delete_messages()
-        # assumed messages list of following type dicts
-        # {'number': 'xxxx', 'body': 'some text'}
+        status = 'REC UNREAD' if self._checked else 'ALL'
+        try:
+            messages = self.gsm.get_messages(status)
+        except GSMError as e:
+            print('reading messages failed:', e)
+            return
+        self._checked = True
 
         print('checking received messages. found:', len(messages))
 
         for msg in messages:
-            num = msg.number
-            body = msg.body
-
-            if body.startswith('sensor'):
-                task_params = {'number': num}
-                print(num, 'sensor')
-                task = {'type': TASK_TYPE.SEND_SENSOR_DATA, 'data': task_params}
-                self.tasks.append(task)
-
-            elif body.startswith('get alarms'):
-                task_params = {'number': num}
-                print(num, 'get alarms')
-                task = {'type': TASK_TYPE.SEND_ALARM_STATE, 'data': task_params}
-                self.tasks.append(task)
-
-            elif body.startswith('state'):
-                task_params = {'number': num}
-                print(num, 'state')
-                task = {'type': TASK_TYPE.SEND_LOGGER_STATE, 'data': task_params}
-                self.tasks.append(task)
-
-            elif body.startswith('get profiles'):
-                task_params = {'number': num}
-                print(num, 'get profiles')
-                task = {'type': TASK_TYPE.SEND_PROFILES, 'data': task_params}
-                self.tasks.append(task)
-
-            elif body.startswith('set profile,'):
-                task_params = {'number': num, 'profile': body[2:]}
-                print(num, 'set profile')
-                task = {'type': TASK_TYPE.SET_PROFILE, 'data': task_params}
-                self.tasks.append(task)
-
-            elif body.startswith('interval,'):
-                task_params = {'number': num, 'interval': body[2:]}
-                print(num, 'interval')
-                task = {'type': TASK_TYPE.SET_LOGGING_INTERVAL, 'data': task_params}
-                self.tasks.append(task)
-
-            elif body.startswith('new logfile'):
-                task_params = {'number': num}
-                print(num, 'new logfile')
-                task = {'type': TASK_TYPE.NEW_LOG_FILE, 'data': task_params}
-                self.tasks.append(task)
-
-            elif body.startswith('alarms,receive'):
-                task_params = {'number': num}
-                print(num, 'alarms')
-                task = {'type': TASK_TYPE.SET_NUMBER, 'data': task_params}
-                self.tasks.append(task)
-
-            elif body.startswith('alarms,mute'):
-                task_params = {'number': num}
-                print(num, 'alarms')
-                task = {'type': TASK_TYPE.REMOVE_NUMBER, 'data': task_params}
-                self.tasks.append(task)
-
-            elif body.startswith('help'):
-                task_params = {'number': num}
-                print(num, 'help')
-                task = {'type': TASK_TYPE.HELP, 'data': task_params}
-                self.tasks.append(task)
-
-            elif body.startswith('restart'):
-                task_params = {}
-                print(num, 'restart')
-                task = {'type': TASK_TYPE.RESTART, 'data': task_params}
-                self.tasks.append(task)
+            self.handle_message(msg)
 
-            else:
-                print(num, 'unknown command')
-                self.send_message(num, 'Unknown command')
+        try:
+            self.gsm.delete_messages([msg.mid for msg in messages])
+        except GSMError as e:
+            print('deleting messages failed:', e)
+
+    # Runs in the worker thread. Reads only the messages
+    # announced by new message notifications
+    def check_new_messages(self, timeout):
+        try:
+            for index in self.gsm.read_unsolicited(timeout):
+                msg = self.gsm.read_message(index)
+                self.gsm.delete_message(index)
+                if msg is not None:
+                    self.handle_message(msg)
+        except GSMError as e:
+            print('reading new message failed:', e)
+
+    # Creates the task for the command in the received message
+    def handle_message(self, msg):
+        num = msg.number
+        body = msg.body
+        metrics.inc('sms_received_total')
+
+        # In fleet mode the command is prefixed with '<container>:'
+        logger = None
+        prefix, sep, command = body.partition(':')
+        if sep and ',' not in prefix:
+            logger = prefix.strip()
+            body = command.strip()
+
+        if body.startswith('sensor'):
+            task_params = {'number': num}
+            print(num, 'sensor')
+            task = {'type': TASK_TYPE.SEND_SENSOR_DATA, 'data': task_params}
+            self._add_task(task, logger)
+
+        elif body.startswith('get alarms'):
+            task_params = {'number': num}
+            print(num, 'get alarms')
+            task = {'type': TASK_TYPE.SEND_ALARM_STATE, 'data': task_params}
+            self._add_task(task, logger)
+
+        elif body.startswith('state'):
+            task_params = {'number': num}
+            print(num, 'state')
+            task = {'type': TASK_TYPE.SEND_LOGGER_STATE, 'data': task_params}
+            self._add_task(task, logger)
+
+        elif body.startswith('get profiles'):
+            task_params = {'number': num}
+            print(num, 'get profiles')
+            task = {'type': TASK_TYPE.SEND_PROFILES, 'data': task_params}
+            self._add_task(task, logger)
+
+        elif body.startswith('set profile,'):
+            task_params = {'number': num,
+                           'profile': body.split(',', 1)[1].strip()}
+            print(num, 'set profile')
+            task = {'type': TASK_TYPE.SET_PROFILE, 'data': task_params}
+            self._add_task(task, logger)
 
+        elif body.startswith('interval,'):
+            task_params = {'number': num,
+                           'interval': body.split(',', 1)[1].strip()}
+            print(num, 'interval')
+            task = {'type': TASK_TYPE.SET_LOGGING_INTERVAL, 'data': task_params}
+            self._add_task(task, logger)
+
+        elif body.startswith('new logfile'):
+            task_params = {'number': num}
+            print(num, 'new logfile')
+            task = {'type': TASK_TYPE.NEW_LOG_FILE, 'data': task_params}
+            self._add_task(task, logger)
+
+        elif body.startswith('alarms,receive'):
+            task_params = {'number': num}
+            print(num, 'alarms')
+            task = {'type': TASK_TYPE.SET_NUMBER, 'data': task_params}
+            self._add_task(task, logger)
+
+        elif body.startswith('alarms,mute'):
+            task_params = {'number': num}
+            print(num, 'alarms')
+            task = {'type': TASK_TYPE.REMOVE_NUMBER, 'data': task_params}
+            self._add_task(task, logger)
+
+        elif body.startswith('history,'):
+            params = body.split(',')
+            task_params = {'number': num,
+                           'start': params[1],
+                           'end': params[2] if len(params) > 2 else ''}
+            print(num, 'history')
+            task = {'type': TASK_TYPE.SEND_HISTORY, 'data': task_params}
+            self._add_task(task, logger)
+
+        elif body.startswith('stats'):
+            task_params = {'number': num}
+            print(num, 'stats')
+            task = {'type': TASK_TYPE.SEND_STATS, 'data': task_params}
+            self._add_task(task, logger)
+
+        elif body.startswith('help'):
+            task_params = {'number': num}
+            print(num, 'help')
+            task = {'type': TASK_TYPE.HELP, 'data': task_params}
+            self._add_task(task, logger)
+
+        elif body.startswith('reload'):
+            task_params = {'number': num}
+            print(num, 'reload')
+            task = {'type': TASK_TYPE.RELOAD_SETTINGS, 'data': task_params}
+            self._add_task(task, logger)
+
+        elif body.startswith('restart'):
+            task_params = {'number': num}
+            print(num, 'restart')
+            task = {'type': TASK_TYPE.RESTART, 'data': task_params}
+            self._add_task(task, logger)
+
+        else:
+            print(num, 'unknown command')
+            self.send_message(num, 'Unknown command')
+
+    # Queues the message for the worker thread and returns immediately.
+    # The returned OutboundMessage can be waited on for delivery confirmation.
+    # Messages are sent in the order of 'priority' and then 'deadline'
+    # (seconds from now). Replies are dropped if not sent within
+    # REPLY_DEADLINE seconds and a reply identical to a pending one is
+    # not queued again. A message which could not be sent is retried
+    # until its deadline, also after a restart.
+    def send_message(self, number, message, priority=PRIORITY_REPLY,
+                     deadline=None):
+        if deadline is None and priority == PRIORITY_REPLY:
+            deadline = REPLY_DEADLINE
+        if deadline is not None:
+            deadline += time.time()
+
+        with self._outbox_lock:
+            mid = None
+            if priority == PRIORITY_REPLY:
+                mid = self.outbox.find(number, message, priority)
+            if mid is not None:
+                metrics.inc('sms_coalesced_total')
+            else:
+                mid = self.outbox.put(number, message, priority, deadline)
 
+            if mid not in self._handles:
+                self._handles[mid] = OutboundMessage(number, message,
+                                                     priority, deadline)
+            msg = self._handles[mid]
+        self._wakeup.set()
+        return msg
 
-    def send_message(self, number, message):
-        self.gsm.send_message(number, message)
+    # Returns True if the message was sent, False if it should be retried
+    # and None if it can never be sent (invalid number or message)
+    def _send(self, number, message):
+        try:
+            self.gsm.send_message(number, pack_message(message))
+            metrics.inc('sms_sent_total')
+            return True
+        except (InvalidNumberError, ValueError, TypeError, KeyError) as e:
+            print('dropped unsendable message to', number + ':', e)
+            metrics.inc('sms_dropped_total')
+            return None
+        except GSMError as e:
+            print('sending message failed:', e)
+            metrics.inc('sms_failed_total')
+            return False
+        except Exception as e:
+            # For example the serial port is gone, the worker keeps running
+            print('sending message failed:', e)
+            metrics.inc('sms_failed_total')
+            return False
 
     def get_tasks(self):
-        ret = self.tasks.copy()
-        self.tasks.clear()
+        metrics.set_gauge('outbox_messages', len(self.outbox))
+        with self._tasks_lock:
+            metrics.set_gauge('communication_tasks', len(self.tasks))
+            ret = self.tasks.copy()
+            self.tasks.clear()
         return ret
@@ -0,0 +1,172 @@
+import gzip
+import os
+import queue
+import shutil
+import threading
+import zlib
+from datetime import datetime
+
+from binary_log import HEADER, RECORD
+
+
+"""
+Compression of closed log files and reading of compressed and
+uncompressed log files.
+
+LogCompressor compresses the files given to it in a low priority
+background thread. The compressed file is decompressed and compared to
+the original (CRC-32 and length) before the original is removed.
+
+iter_records reads the records of any log file (.txt, .bin, .txt.gz or
+.bin.gz) one at a time without loading the file into memory.
+
+Usage:
+
+    compressor = LogCompressor()
+    compressor.submit('log_data/20221030_121212.txt')
+
+    for t, temp, hum in iter_records('log_data/20221030_121212.txt.gz'):
+        print(t, temp, hum)
+"""
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def open_log(fpath):
+    """
+    Opens a log file for binary reading, decompressing if it ends with .gz.
+    """
+    if fpath.endswith('.gz'):
+        return gzip.open(fpath, 'rb')
+    return open(fpath, 'rb')
+
+
+def uncompressed_name(fpath):
+    return fpath[:-len('.gz')] if fpath.endswith('.gz') else fpath
+
+
+def parse_record(line):
+    """
+    Parses a text log line 'YYYYmmdd_HHMMSS<TAB>temperature<TAB>humidity'
+    into (epoch time, temperature, humidity).
+    """
+    ts, temp, hum = line.split('\t')
+    t = datetime(int(ts[0:4]), int(ts[4:6]), int(ts[6:8]),
+                 int(ts[9:11]), int(ts[11:13]), int(ts[13:15])).timestamp()
+    return t, float(temp), float(hum)
+
+
+def iter_records(fpath):
+    """
+    Yields (epoch time, temperature, humidity) of every record in the file.
+    """
+    with open_log(fpath) as f:
+        if uncompressed_name(fpath).endswith('.bin'):
+            f.read(HEADER.size)
+            while True:
+                data = f.read(RECORD.size * 1024)
+                usable = len(data) - len(data) % RECORD.size
+                yield from RECORD.iter_unpack(data[:usable])
+                if len(data) < RECORD.size * 1024:
+                    return
+        else:
+            f.readline()  # Header
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Still being written
+                    return
+                try:
+                    yield parse_record(line.decode())
+                except ValueError:
+                    continue
+
+
+def _crc(f):
+    crc = 0
+    length = 0
+    while True:
+        data = f.read(CHUNK_SIZE)
+        if not data:
+            return crc, length
+        crc = zlib.crc32(data, crc)
+        length += len(data)
+
+
+def compress_file(fpath):
+    """
+    Compresses 'fpath' to 'fpath'.gz and removes the original after the
+    compressed file has been verified. Returns the path of the compressed
+    file, raises OSError or ValueError if compressing failed.
+    """
+    gz_fpath = fpath + '.gz'
+    tmp_fpath = gz_fpath + '.tmp'
+    try:
+        with open(fpath, 'rb') as src, gzip.open(tmp_fpath, 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+        with open(fpath, 'rb') as src, gzip.open(tmp_fpath, 'rb') as dst:
+            if _crc(src) != _crc(dst):
+                raise ValueError(f'Compressed file does not match: {fpath}')
+
+        with open(tmp_fpath, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_fpath, gz_fpath)
+    except (OSError, ValueError, EOFError, zlib.error):
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+        raise
+
+    os.remove(fpath)
+    return gz_fpath
+
+
+class LogCompressor:
+    # Niceness of the compressing thread
+    NICENESS = 19
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, fpath):
+        """
+        Queues a closed log file for compressing.
+        """
+        self._queue.put(fpath)
+
+    def submit_closed(self, directory, active):
+        """
+        Queues the uncompressed log files in 'directory' except 'active',
+        for example files left by an earlier run.
+        """
+        for name in sorted(os.listdir(directory)):
+            fpath = os.path.join(directory, name)
+            if name.endswith(('.txt', '.bin')) and \
+                    os.path.abspath(fpath) not in map(os.path.abspath, active):
+                self.submit(fpath)
+
+    def join(self):
+        """
+        Waits until the queued files have been compressed.
+        """
+        self._queue.join()
+
+    def _run(self):
+        try:
+            # Lower the priority of this thread only so that
+            # compressing does not delay the sampling
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(),
+                           self.NICENESS)
+        except (AttributeError, OSError):
+            pass
+
+        while True:
+            fpath = self._queue.get()
+            try:
+                compress_file(fpath)
+            except (OSError, ValueError, EOFError, zlib.error) as e:
+                print('compressing log file failed:', e)
+            finally:
+                self._queue.task_done()
@@ -1,20 +1,29 @@
 from datetime import datetime
 import os
 import configparser
-from enum import Enum
 import json
+import threading
 
 from si7021 import Si7021
 from smbus import SMBus
 
 from simulated_sensor import get_sensor_data
 from tasks import TASK_TYPE
+from storage import FileStore, SqliteStore
+from rollups import Rollups
+from compression import LogCompressor
+from snapshot import load_snapshot, save_snapshot
+from sampler import Sampler
+from alarms import ALARM_TYPE, AlarmDigest, AlarmTable
+from profiles import ProfileRegistry
+import metrics
 
 
-# folder structure:
+# folder structure (relative to the base directory of the logger):
 '''
 log_data/
-    20221030_121212.txt
+    20221030_121212.txt.gz  (closed files if compress_logs is set)
+    20221030_121212.bin.gz  (if log_format is binary or both)
     20221130_131200.txt
     20221230_010922.txt
 
@@ -22,27 +31,49 @@ threshold_profiles/
     milk.ini
     fruits.ini
 
-settings.ini (logging_interval, default threshold_profile)
+log_data/logger_state.json (state snapshot for warm starts)
+log_data/readings.db (if log_format includes sqlite)
+
+settings.ini (logging_interval, default threshold_profile, log file format and buffering)
+
+In fleet mode every container has its own base directory with log_data/
+and settings.ini. The threshold profiles are shared.
 '''
 
 
-class ALARM_TYPE(Enum):
-    LOW = 1
-    HIGH = 2
-    NORMAL = 3
+# SMBus instances by I2C bus number, shared by the sensors on the same bus
+_buses = {}
+
+
+def get_bus(number):
+    if number not in _buses:
+        _buses[number] = SMBus(number)
+    return _buses[number]
 
 
 class DataLogger:
 
-    def __init__(self):
-        # Get the sensor at I2C bus 1.
-        self.sensor = Si7021(SMBus(1))
+    # 'base_dir' contains settings.ini and log_data/ of this logger,
+    # 'name' identifies the logger in fleet mode. The threshold 'profiles'
+    # registry and the 'compressor' can be shared by several loggers.
+    def __init__(self, base_dir='.', name=None, profiles=None,
+                 compressor=None):
+        self.name = name
+        self.settings_fpath = os.path.join(base_dir, 'settings.ini')
+        self.log_dir = os.path.join(base_dir, 'log_data')
+        self.profiles = profiles or ProfileRegistry('./threshold_profiles')
+        os.makedirs(self.log_dir, exist_ok=True)
+
+        # Protects the values, alarm state and tasks which
+        # are also updated by the sampler thread
+        self._lock = threading.RLock()
 
         # latest measured sensor data
-        self.latest_values = {'temperature': 10000, 'humidity': 10000}
-        # Largest and smallest sensor values during lifetime of the class
-        self.extreme_values = {'temperature': [10000, -10000],
-                               'humidity': [100, 0]}
+        self.latest_values = {'temperature': None, 'humidity': None}
+        # Smallest and largest sensor values during lifetime of the class,
+        # None until the first sample
+        self.extreme_values = {'temperature': [None, None],
+                               'humidity': [None, None]}
 
         # Thershold values for alarm conditions
         # (min, max, hysteresis)
@@ -50,142 +81,329 @@ class DataLogger:
                            'temperature': (None, None, None),
                            'humidity': (None, None, None)}
 
-        # Keeps track of alarms to prevent repeating the same alarm
-        self.alarm_state = {'temperature': [False, False],
-                            'humidity': [False, False]}
-
         # File for storing settings
         self.settings = configparser.ConfigParser()
-        self.settings.read('settings.ini')
-        self.use_threshold_profile(self.settings.get('DEFAULT',
-                                                     'threshold_profile'))
-
-        self.log_interval = self.settings.getint('DEFAULT', 'log_interval')
-
-        self.alarm_numbers = json.loads(
-            self.settings.get('DEFAULT', 'numbers'))
-
-        # New log data file every time program run
-        self.log_fpath = None
-        self.create_log_file()
+        self.settings.read(self.settings_fpath)
+
+        # Get the sensor at I2C bus 1 or the bus given in the settings
+        self.sensor = Si7021(get_bus(
+            self.settings.getint('DEFAULT', 'i2c_bus', fallback=1)))
+
+        # Additional sensors {name: I2C bus}, for example at different
+        # positions of the container. They are read at every logging
+        # interval for the alarms.
+        self.extra_sensors = {
+            name: Si7021(get_bus(bus)) for name, bus in json.loads(
+                self.settings.get('DEFAULT', 'extra_sensors',
+                                  fallback='{}')).items()}
+
+        # Alarm limits and state of every channel. Keeps track of alarms
+        # to prevent repeating the same alarm.
+        channels = ['temperature', 'humidity']
+        for name in self.extra_sensors:
+            channels += [f'{name} temperature', f'{name} humidity']
+        self.alarms = AlarmTable(
+            channels, variables=[channel.rsplit(' ', 1)[-1]
+                                 for channel in channels])
+
+        # Storage backends, comma separated: 'text', 'binary' ('both' is
+        # text and binary) and 'sqlite'
+        log_format = self.settings.get('DEFAULT', 'log_format',
+                                       fallback='text')
+        self.log_formats = {fmt.strip() for fmt in
+                            log_format.replace('both', 'text,binary')
+                            .split(',')}
+        if not self.log_formats or \
+                not self.log_formats <= {'text', 'binary', 'sqlite'}:
+            raise ValueError(f'Unknown log format: {log_format}')
+
+        # Buffering of the log writes
+        self.log_flush_count = self.settings.getint(
+            'DEFAULT', 'log_flush_count', fallback=10)
+        self.log_flush_seconds = self.settings.getint(
+            'DEFAULT', 'log_flush_seconds', fallback=300)
+        self.log_fsync = self.settings.get('DEFAULT', 'log_fsync',
+                                           fallback='commit')
+        # Samples and sent alarm digests not in the snapshot yet. The
+        # snapshot is saved with the same bounds as the log records,
+        # raised alarms and log file changes are saved at once.
+        self._unsaved_changes = 0
+
+        # Closed log files are compressed in the background
+        self.compressor = None
+        if self.settings.getboolean('DEFAULT', 'compress_logs',
+                                    fallback=False):
+            self.compressor = compressor or LogCompressor()
+
+        # Log files per run and/or the readings database
+        self.files = None
+        if self.log_formats & {'text', 'binary'}:
+            self.files = FileStore(
+                self.log_dir, text='text' in self.log_formats,
+                binary='binary' in self.log_formats,
+                compressor=self.compressor,
+                flush_count=self.log_flush_count,
+                flush_seconds=self.log_flush_seconds, fsync=self.log_fsync)
+        self.database = None
+        if 'sqlite' in self.log_formats:
+            self.database = SqliteStore(
+                os.path.join(self.log_dir, 'readings.db'),
+                flush_count=self.log_flush_count,
+                flush_seconds=self.log_flush_seconds)
+        self.stores = [store for store in (self.files, self.database)
+                       if store is not None]
+
+        self.reload_settings()
+
+        # Alarms are sent after they have lasted alarm_dwell seconds,
+        # at most one message per alarm_min_interval seconds to a number
+        self.alarm_digest = AlarmDigest(
+            dwell=self.settings.getfloat('DEFAULT', 'alarm_dwell',
+                                         fallback=0),
+            min_interval=self.settings.getfloat(
+                'DEFAULT', 'alarm_min_interval', fallback=0))
+
+        # Hourly and daily aggregates
+        self.rollups = Rollups(self.log_dir)
+
+        # Values, alarms, aggregates and active log file of the previous
+        # run are restored from the snapshot so that a restart does not
+        # repeat alarms or lose the extremes
+        self.state_fpath = os.path.join(self.log_dir, 'logger_state.json')
+        state = load_snapshot(self.state_fpath)
+        if state is not None:
+            self.restore_state(state)
+        else:
+            # New log data file when starting without a snapshot
+            self.create_log_file()
+            self.log_event('profile', self.thresholds['profile_name'])
+
+        if self.compressor is not None:
+            # Files closed by earlier runs
+            self.compressor.submit_closed(self.log_dir, self._log_fpaths())
 
         self.tasks = []
+        # Called without arguments when a task is added, from any thread
+        self.on_task = None
+
+        # Sensor reads per second in the background, 0: read once
+        # per logging interval. Alarms are checked for every sample
+        # and the log gets the mean of the interval.
+        self.sampler = None
+        sample_rate = self.settings.getfloat('DEFAULT', 'sample_rate',
+                                             fallback=0)
+        if sample_rate > 0:
+            self.sampler = Sampler(
+                lambda: self.read_sensor(self.sensor), rate=sample_rate,
+                capacity=self.settings.getint('DEFAULT', 'sample_buffer',
+                                              fallback=3600),
+                on_sample=self._on_sample)
+            self.sampler.start()
 
     # Create new log file. For initializing and
-    # when future data is wanted in a separate file
-    def create_log_file(self):
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        fpath = os.path.join('./log_data', timestamp + '.txt')
-
-        with open(fpath, 'w') as f:
-            f.write('time\ttemperature\thumidity\n')
-        self.log_fpath = fpath
+    # when future data is wanted in a separate file.
+    # If 'timestamp' is given the existing files of that timestamp are
+    # continued if they exist.
+    def create_log_file(self, timestamp=None):
+        append = timestamp is not None
+        if timestamp is None:
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        for store in self.stores:
+            store.open(timestamp, append)
+
+        self.log_timestamp = timestamp
+        self.save_state()
         return timestamp
 
+    # Snapshot of the state which is not in the settings file
+    def get_state_snapshot(self):
+        return {'latest_values': self.latest_values,
+                'extreme_values': self.extreme_values,
+                'alarm_state': self.alarm_state,
+                # Alarms raised but not yet sent
+                'alarm_digest': self.alarm_digest.get_state(),
+                'profile_name': self.thresholds['profile_name'],
+                'log_timestamp': self.log_timestamp,
+                'rollups': self.rollups.dump()}
+
+    def save_state(self):
+        with self._lock:
+            self._unsaved_changes = 0
+            try:
+                save_snapshot(self.state_fpath, self.get_state_snapshot())
+            except OSError as e:
+                print('saving logger state failed:', e)
+
+    # Continue from a snapshot saved by save_state
+    def restore_state(self, state):
+        self.latest_values.update(state.get('latest_values', {}))
+        self.extreme_values.update(state.get('extreme_values', {}))
+        self.rollups.load(state.get('rollups', {}))
+
+        # Alarms of another profile are evaluated again. The profile has
+        # been changed in the settings file while not running
+        if state.get('profile_name') == self.thresholds['profile_name']:
+            self.alarms.load_state(state.get('alarm_state', {}))
+        else:
+            self.log_event('profile', self.thresholds['profile_name'])
+        try:
+            self.alarm_digest.load_state(state.get('alarm_digest', {}))
+        except (KeyError, ValueError, TypeError) as e:
+            print('restoring alarm digest failed:', e)
+
+        # The log file of the previous run is continued on the same day
+        timestamp = state.get('log_timestamp')
+        if timestamp and timestamp[:8] == datetime.now().strftime('%Y%m%d'):
+            self.create_log_file(timestamp)
+        else:
+            self.create_log_file()
+
+    # Write the buffered log records which have waited too long and the
+    # snapshot if it has changed since it was saved. Called
+    # every log_flush_seconds
+    def flush_log(self):
+        for store in self.stores:
+            store.flush_expired()
+        with self._lock:
+            if self._unsaved_changes:
+                self.save_state()
+
+    # Summary of the logged records between epoch times start and end
+    def get_history(self, start, end):
+        store = self.database or self.files
+        return store.query(start, end)
+
+    # Store an event, for example a profile change or an alarm,
+    # with the readings
+    def log_event(self, kind, detail):
+        now = datetime.now()
+        for store in self.stores:
+            store.write_event(now, kind, detail)
+
+    def _log_fpaths(self):
+        return self.files.fpaths() if self.files is not None else []
+
+    def _close_log_files(self):
+        for store in self.stores:
+            store.close()
+
+    # Stop sampling, write all buffered log records, close the log files
+    # and save the state
+    def close(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+        self._close_log_files()
+        self.save_state()
+
+    # Timed sensor read, returns (humidity, temperature)
+    def read_sensor(self, sensor):
+        with metrics.timer('sensor_read_seconds'):
+            try:
+                return sensor.read()
+            except OSError:
+                metrics.inc('sensor_errors_total')
+                raise
+
     # For collecting data and updating related variables
     def log_data(self):
-        # get sensor data
-        # temp, hum = get_sensor_data()  # Remove this later
-        hum, temp = self.sensor.read()
-
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-
-        # log data to file
-        with open(self.log_fpath, 'a') as f:
-            f.write(f'{timestamp}\t{round(temp,2)}\t{round(hum, 2)}\n')
-
-        # update latest values
-        self.latest_values['temperature'] = temp
-        self.latest_values['humidity'] = hum
-
-        # update extreme values
-        temp_min = self.extreme_values['temperature'][0]
-        temp_max = self.extreme_values['temperature'][1]
-        hum_min = self.extreme_values['humidity'][0]
-        hum_max = self.extreme_values['humidity'][1]
-        if temp_min is None or temp < temp_min:
-            self.extreme_values['temperature'][0] = temp
-        if temp_min is None or temp > temp_max:
-            self.extreme_values['temperature'][1] = temp
-        if temp_min is None or hum < hum_min:
-            self.extreme_values['humidity'][0] = hum
-        if temp_min is None or hum > hum_max:
-            self.extreme_values['humidity'][1] = hum
-
-        # check threshold conditions and
-        # set alarm if needed and same condition has not yet been alarmed
-
-        # For temperature
-
-        # (min, max, hysteresis)
-        temp_th = self.thresholds['temperature']
-
-        if temp < temp_th[0] and not self.alarm_state['temperature'][0]:
-            self.send_alarm('temperature', ALARM_TYPE.LOW)
-            self.alarm_state['temperature'][0] = True
-
-        elif temp > temp_th[1] and not self.alarm_state['temperature'][1]:
-            self.send_alarm('temperature', ALARM_TYPE.HIGH)
-            self.alarm_state['temperature'][1] = True
-
-        if temp > (temp_th[0] + temp_th[2]) and self.alarm_state['temperature'][0]:
-            if not self.alarm_state['temperature'][1]:
-                self.send_alarm('temperature', ALARM_TYPE.NORMAL)
-            self.alarm_state['temperature'][0] = False
-
-        elif temp < (temp_th[1] - temp_th[2]) and self.alarm_state['temperature'][1]:
-            if not self.alarm_state['temperature'][0]:
-                self.send_alarm('temperature', ALARM_TYPE.NORMAL)
-            self.alarm_state['temperature'][1] = False
-
-        # For humidity
-
-        # (min, max, hysteresis)
-        hum_th = self.thresholds['humidity']
-
-        if hum < hum_th[0] and not self.alarm_state['humidity'][0]:
-            self.send_alarm('humidity', ALARM_TYPE.LOW)
-            self.alarm_state['humidity'][0] = True
-
-        elif hum > hum_th[1] and not self.alarm_state['humidity'][1]:
-            self.send_alarm('humidity', ALARM_TYPE.HIGH)
-            self.alarm_state['humidity'][1] = True
-
-        if hum > (hum_th[0] + hum_th[2]) and self.alarm_state['humidity'][0]:
-            if not self.alarm_state['humidity'][1]:
-                self.send_alarm('humidity', ALARM_TYPE.NORMAL)
-            self.alarm_state['humidity'][0] = False
-
-        elif hum < (hum_th[1] - hum_th[2]) and self.alarm_state['humidity'][1]:
-            if not self.alarm_state['humidity'][0]:
-                self.send_alarm('humidity', ALARM_TYPE.NORMAL)
-            self.alarm_state['humidity'][1] = False
+        with metrics.timer('log_data_seconds'):
+            self._log_data()
+
+    def _log_data(self):
+        now = datetime.now()
+
+        if self.sampler is not None:
+            # Aggregate of the samples taken during the logging interval
+            stats = self.sampler.aggregate()
+            if stats is None:
+                print('no sensor samples during the logging interval')
+                return
+            temp, temp_low, temp_high = stats['temperature']
+            hum, hum_low, hum_high = stats['humidity']
+        else:
+            # get sensor data
+            # temp, hum = get_sensor_data()  # Remove this later
+            hum, temp = self.read_sensor(self.sensor)
+            temp_low = temp_high = temp
+            hum_low = hum_high = hum
+
+        # log data to the storage backends
+        for store in self.stores:
+            store.write_sample(now, temp, hum)
+
+        with self._lock:
+            # update latest values, updated by every sample when sampling
+            if self.sampler is None:
+                self.latest_values['temperature'] = temp
+                self.latest_values['humidity'] = hum
+
+            # update extreme values
+            lows = {'temperature': temp_low, 'humidity': hum_low}
+            highs = {'temperature': temp_high, 'humidity': hum_high}
+            for variable in ('temperature', 'humidity'):
+                extremes = self.extreme_values[variable]
+                if extremes[0] is None or lows[variable] < extremes[0]:
+                    extremes[0] = lows[variable]
+                if extremes[1] is None or highs[variable] > extremes[1]:
+                    extremes[1] = highs[variable]
+
+            # update hourly and daily aggregates
+            self.rollups.add(now, {'temperature': temp, 'humidity': hum},
+                             lows, highs)
+
+            # alarms of the main sensor are checked for every sample
+            # when sampling
+            values = self.read_extra_sensors()
+            if self.sampler is None:
+                values.update({'temperature': temp, 'humidity': hum})
+            self._unsaved_changes += 1
+            if self.check_alarms(values) or \
+                    self._unsaved_changes >= self.log_flush_count:
+                self.save_state()
 
         # print logger state
         print('sensors:', self.latest_values)
         print()
         print(self.get_state())
 
-    # For reading alarm thershold data by threshold profile name
+    # Called by the sampler thread for every sample
+    def _on_sample(self, t, hum, temp):
+        with self._lock:
+            self.latest_values['temperature'] = temp
+            self.latest_values['humidity'] = hum
+            if self.check_alarms({'temperature': temp, 'humidity': hum}):
+                self.save_state()
+
+    # Check threshold conditions of the measured 'values' {channel: value}
+    # and send the alarms of the changed conditions. Returns True if the
+    # alarm state changed.
+    def check_alarms(self, values):
+        events = self.alarms.evaluate(values)
+        for channel, type in events:
+            self.send_alarm(channel, type, values.get(channel))
+        return bool(events)
+
+    # Read the extra sensors, returns {channel: value}
+    def read_extra_sensors(self):
+        values = {}
+        for name, sensor in self.extra_sensors.items():
+            try:
+                hum, temp = self.read_sensor(sensor)
+            except OSError as e:
+                print(f'reading sensor {name} failed:', e)
+                continue
+            values[f'{name} temperature'] = temp
+            values[f'{name} humidity'] = hum
+        return values
+
+    # For reading alarm thershold data by threshold profile name.
+    # Raises ValueError if the profile does not exist or is invalid.
     def read_threshold_profile(self, profile_name):
-        profile = configparser.ConfigParser()
-        profile.read(os.path.join(
-            './threshold_profiles', profile_name + '.ini'))
-        min_temp = profile.getint('TEMPERATURE', 'min')
-        max_temp = profile.getint('TEMPERATURE', 'max')
-        hyst_temp = profile.getint('TEMPERATURE', 'hysteresis')
-
-        min_hum = profile.getint('HUMIDITY', 'min')
-        max_hum = profile.getint('HUMIDITY', 'max')
-        hyst_hum = profile.getint('HUMIDITY', 'hysteresis')
-
-        return {'profile_name': profile_name,
-                'temperature': (min_temp, max_temp, hyst_temp),
-                'humidity': (min_hum, max_hum, hyst_hum)}
+        return self.profiles.get(profile_name)
 
     def update_setting_file(self):
         try:
-            with open('settings.ini', 'w') as configfile:
+            with open(self.settings_fpath, 'w') as configfile:
                 self.settings.write(configfile)
             return True
 
@@ -195,20 +413,47 @@ class DataLogger:
     # Start using alarm threhold data of defined profile name and
     # save the profile name to settings to use same profile at next run
     def use_threshold_profile(self, profile_name):
-        try:
-            self.thresholds = self.read_threshold_profile(profile_name)
-        except Exception:
-            raise ValueError(
-                f'Reading threshold profile failed: {profile_name}')
+        thresholds = self.read_threshold_profile(profile_name)
+        # The sampler thread evaluates the alarms with the limits
+        with self._lock:
+            # At the start the previous profile comes from the snapshot,
+            # see restore_state
+            previous = self.thresholds['profile_name']
+            if previous is not None and \
+                    thresholds['profile_name'] != previous:
+                self.log_event('profile', profile_name)
+            self.thresholds = thresholds
+            self.alarms.set_limits(self.thresholds)
 
         self.settings['DEFAULT']['threshold_profile'] = profile_name
         self.update_setting_file()
 
-    # Set log interval to settings. The interval will be applied at next run
+    # Read threshold profile, log interval and alarm numbers from the
+    # settings file and start using them. Raises ValueError if invalid.
+    def reload_settings(self):
+        self.settings.read(self.settings_fpath)
+        self.use_threshold_profile(self.settings.get('DEFAULT',
+                                                     'threshold_profile'))
+
+        log_interval = self.settings.getint('DEFAULT', 'log_interval')
+        if log_interval <= 0:
+            raise ValueError(f'Invalid log interval: {log_interval}')
+        self.log_interval = log_interval
+
+        self.alarm_numbers = json.loads(
+            self.settings.get('DEFAULT', 'numbers'))
+
+    # Set log interval and save it to settings. The logging job has to be
+    # rescheduled with the new interval (see main.schedule_logging)
     def set_log_interval(self, interval):
-        if not isinstance(interval, int) or interval <= 0:
+        try:
+            interval = int(interval)
+        except (TypeError, ValueError):
+            return False
+        if interval <= 0:
             return False
 
+        self.log_interval = interval
         self.settings['DEFAULT']['log_interval'] = str(interval)
         self.update_setting_file()
         return True
@@ -233,11 +478,19 @@ class DataLogger:
 
     # Get list of existing alarm threhold profile files
     def get_threshold_profiles(self):
-        return [fn.rsplit('.', 1)[0] for fn in os.listdir('./threshold_profiles')]
+        return self.profiles.names()
 
     def get_extreme_values(self):
         return self.extreme_values
 
+    # period: 'hour' or 'day'
+    # Returns {variable: (min, max, mean)} of the current period
+    def get_rollup(self, period):
+        bucket = self.rollups.get(period)
+        return {variable: (bucket[variable][2], bucket[variable][3],
+                           self.rollups.mean(bucket[variable]))
+                for variable in ('temperature', 'humidity')}
+
     def get_values(self):
         return self.latest_values
 
@@ -249,33 +502,46 @@ class DataLogger:
 
     # if ignore_hysteresis: alarms will be disabled if they are depending on hysteresis
     def get_alarms(self, ignore_hysteresis=False):
+        with self._lock:
+            return self._get_alarms(ignore_hysteresis)
+
+    def _get_alarms(self, ignore_hysteresis):
         if ignore_hysteresis:
-            temp = self.latest_values['temperature']
-            if temp > self.thresholds['temperature'][0] and self.alarm_state['temperature'][0]:
-                self.send_alarm('temperature', ALARM_TYPE.NORMAL)
-                self.alarm_state['temperature'][0] = False
-            elif temp < self.thresholds['temperature'][1] and self.alarm_state['temperature'][1]:
-                self.send_alarm('temperature', ALARM_TYPE.NORMAL)
-                self.alarm_state['temperature'][1] = False
-
-            hum = self.latest_values['humidity']
-            if hum > self.thresholds['humidity'][0] and self.alarm_state['humidity'][0]:
-                self.send_alarm('humidity', ALARM_TYPE.NORMAL)
-                self.alarm_state['humidity'][0] = False
-            elif hum < self.thresholds['humidity'][1] and self.alarm_state['humidity'][1]:
-                self.send_alarm('humidity', ALARM_TYPE.NORMAL)
-                self.alarm_state['humidity'][1] = False
+            for channel, type in self.alarms.clear(self.latest_values):
+                self.send_alarm(channel, type, self.latest_values[channel])
+            self.save_state()
 
         return self.alarm_state
 
-    # variable: 'temperature' or 'humidity'
+    # {channel: [low alarm, high alarm]}
+    @property
+    def alarm_state(self):
+        return self.alarms.get_state()
+
+    # variable: alarm channel, for example 'temperature' or
+    # '<extra sensor name> humidity'
     # type: ALARM_TYPE.LOW or ALARM_TYPE.HIGH or ALARM_TYPE.NORMAL
-    def send_alarm(self, variable, type):
-        task_params = {'numbers': self.alarm_numbers,
-                       'variable': variable,
-                       'type': type}
-        task = {'type': TASK_TYPE.SEND_ALARM, 'data': task_params}
-        self.tasks.append(task)
+    # value: the measured value
+    # The alarm is sent by flush_alarms after debouncing
+    def send_alarm(self, variable, type, value=None):
+        self.log_event('alarm', f'{type.name} {variable} {value}')
+        with self._lock:
+            self.alarm_digest.add(variable, type, value)
+        if self.on_task is not None:
+            self.on_task()
+
+    # Create the tasks of the alarm digests which are due. Returns the
+    # time.time() of the next digest, None if no alarms are waiting.
+    def flush_alarms(self):
+        with self._lock:
+            for number, events in self.alarm_digest.due(self.alarm_numbers):
+                # Saved later, a restart before that repeats the digest
+                # rather than losing it
+                self._unsaved_changes += 1
+                task_params = {'numbers': [number], 'events': events}
+                task = {'type': TASK_TYPE.SEND_ALARM, 'data': task_params}
+                self.tasks.append(task)
+            return self.alarm_digest.next_due()
 
     def get_state(self):
         profile_name = self.thresholds['profile_name']
@@ -291,16 +557,11 @@ class DataLogger:
             num_str += num + '\n'
 
         alarm_str = 'Alarms:\n'
-        alarms = self.get_alarms()
-        if alarms['temperature'][0]:
-            alarm_str += 'Low temperature\n'
-        elif alarms['temperature'][1]:
-            alarm_str += 'High temperature\n'
-
-        if alarms['humidity'][0]:
-            alarm_str += 'Low humidity\n'
-        elif alarms['humidity'][1]:
-            alarm_str += 'High humidity\n'
+        for channel, (low, high) in self.get_alarms().items():
+            if low:
+                alarm_str += f'Low {channel}\n'
+            elif high:
+                alarm_str += f'High {channel}\n'
 
         ret = f'Logger state:\n' \
               f'\n' \
@@ -320,6 +581,8 @@ class DataLogger:
 
     def get_tasks(self):
         # clear and return self.tasks
-        ret = self.tasks.copy()
-        self.tasks.clear()
+        with self._lock:
+            metrics.set_gauge('logger_tasks', len(self.tasks))
+            ret = self.tasks.copy()
+            self.tasks.clear()
         return ret
@@ -1,8 +1,14 @@
+import codecs
+import csv
+import random
 import time
 from dataclasses import dataclass
 
 import serial
 
+import metrics
+import sms_pdu
+
 
 """
 GSM Python module for sending/reading/deleting SMS messages.
@@ -26,7 +32,21 @@ Reading messages:
 Deleting messages:
 
     gsm = GSM()
-    gsm.delete_messages()
+    gsm.delete_messages([message.mid for message in messages])
+
+Reacting to new message notifications:
+
+    gsm = GSM()
+    gsm.enable_new_message_indications()
+    for index in gsm.read_unsolicited(timeout=1):
+        message = gsm.read_message(index)
+        gsm.delete_message(index)
+
+HTTP POST over GPRS:
+
+    gsm = GSM()
+    gsm.open_bearer(apn='internet')
+    status = gsm.http_post('http://example.com/upload', b'data')
 
 
 """
@@ -42,90 +62,470 @@ class SMS:
     body: str = ''
 
 
-class GSM:
+class GSMError(Exception):
+    """
+    Raised when the modem answers a command with an error result code
+    or does not answer within the command timeout.
+    """
+
+
+class InvalidNumberError(GSMError):
+    """
+    Raised when a message is addressed to something that is not a phone
+    number, for example an alphanumeric sender name. Sending it again
+    cannot succeed.
+    """
+
+
+# Final result codes that end a command response
+RESULT_OK = 'OK'
+RESULT_ERRORS = ('ERROR', '+CMS ERROR', '+CME ERROR')
+
+# New message indication: +CMTI: "SM",<index>
+NEW_MESSAGE_URC = '+CMTI:'
+
+# Message formats (AT+CMGF)
+PDU_MODE = 0
+TEXT_MODE = 1
+
+# Message status in PDU mode: <stat> of AT+CMGL and the listed messages
+STATUS_CODES = {'REC UNREAD': 0, 'REC READ': 1, 'STO UNSENT': 2,
+                'STO SENT': 3, 'ALL': 4}
+STATUS_NAMES = {code: name for name, code in STATUS_CODES.items()}
+
+# Longest command line accepted by the modem (SIM800)
+MAX_COMMAND_LENGTH = 556
+
+# Prompt sent by the modem when it is waiting for the SMS text (AT+CMGS)
+PROMPT = b'> '
+
+# Sent by the modem when it is waiting for the HTTP data (AT+HTTPDATA)
+DOWNLOAD = 'DOWNLOAD'
+# Result of an HTTP request: +HTTPACTION: <method>,<status>,<length>
+HTTP_ACTION_URC = '+HTTPACTION:'
+# Bearer profile used for HTTP
+BEARER_CID = 1
+
+
+def parse_pdu(header, pdu, indexed=True):
+    """
+    Parses a PDU mode message: the header line fields (after '+CMGL: '
+    or '+CMGR: ', <index>,<stat>,[<alpha>],<length>) and the PDU line.
+    Raises ValueError if the message is malformed.
+    """
+    fields = next(csv.reader([header], skipinitialspace=True))
+    if len(fields) < (4 if indexed else 3):
+        raise ValueError(f'too few fields in message header: {header}')
+
+    mid = int(fields.pop(0)) if indexed else ''
+    status = STATUS_NAMES.get(int(fields[0]), fields[0])
+    number, date, mtime, body = sms_pdu.decode_deliver(pdu)
+    return SMS(number=number, mid=mid, date=date, status=status,
+               mtime=mtime, body=body)
+
+
+class MessageListParser:
+    """
+    Incremental parser for PDU mode AT+CMGL responses.
+
+    Chunks read from the serial port are passed to feed() which yields
+    each SMS as soon as its record is complete. A record is a header line
+    and the PDU line, so no message text can end the listing early. A
+    malformed record is dropped alone.
+    """
+
+    HEADER = '+CMGL: '
+
     def __init__(self):
-        self.ser = serial.Serial("/dev/ttyS0", 115200)
-        self.ser.flushInput()
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._buffer = ''
+        # Header of the record whose PDU line is expected next
+        self._header = None
 
-    def delete_messages(self):
+        # Final result code, None until the whole listing is received
+        self.result = None
+        # Unsolicited result codes received in the middle of the listing
+        self.unsolicited = []
+
+    def feed(self, data):
+        """
+        Parses the next chunk of the response and yields completed messages.
+        """
+        self._buffer += self._decoder.decode(data)
+        while self.result is None and '\n' in self._buffer:
+            line, self._buffer = self._buffer.split('\n', 1)
+            sms = self._parse_line(line.strip())
+            if sms is not None:
+                yield sms
+
+    def remaining(self):
         """
-        Deletes all messages stored on the GSM module.
+        Returns the data received after the final result code, for example
+        a new message notification.
         """
-        self.ser.write('AT\n'.encode())
-        time.sleep(1)
-        self.ser.write('AT+CMGD=1,4\n'.encode())
-        time.sleep(1)
-        self.ser.write('AT+CMGL=\"ALL\"\n'.encode())
-        time.sleep(1)
+        return self._buffer.encode()
+
+    def _parse_line(self, line):
+        if self._header is not None and line:
+            header, self._header = self._header, None
+            try:
+                return parse_pdu(header, line)
+            except ValueError as e:
+                print('invalid message:', e)
+                return None
+
+        if line.startswith(self.HEADER):
+            self._header = line[len(self.HEADER):]
+        elif line == RESULT_OK or line.startswith(RESULT_ERRORS):
+            self.result = line
+        elif line.startswith(NEW_MESSAGE_URC):
+            self.unsolicited.append(line)
+        elif line:
+            print('unexpected data in message list:', line)
+        return None
+
+
+class GSM:
+    # 'ser' replaces the serial port, for example with a
+    # simulated_modem.SimulatedModem
+    def __init__(self, port="/dev/ttyS0", baudrate=115200, ser=None):
+        # Short read timeout so that waiting for a response
+        # can be bounded by the per-command timeout
+        self.ser = ser or serial.Serial(port, baudrate, timeout=0.1)
         self.ser.flushInput()
-        time.sleep(1)
+        self._buffer = b''
+
+        # Storage indices from +CMTI notifications not yet handled
+        self._new_indices = []
+
+        # Current message format (AT+CMGF), None if not known
+        self._format = None
+        # Reference number of the next concatenated message
+        self._concat_ref = random.randrange(256)
+
+        # Disable command echo, the responses are parsed line by line
+        self.command('ATE0')
+
+    def command(self, cmd, timeout=1, prompt=False):
+        """
+        Writes the AT command 'cmd' and returns as soon as the modem
+        has sent its final result code.
+
+        Returns the information lines of the response (without the
+        final result code). If 'prompt' is True the call returns when the
+        modem sends the '>' prompt instead.
+
+        Raises GSMError if the modem answers with an error result code
+        or if no final result code is received within 'timeout' seconds.
+        """
+        # Keep the notifications that arrived while idle
+        self._read_pending()
+        with metrics.timer('gsm_command_seconds'):
+            self.ser.write((cmd + '\r').encode())
+            try:
+                return self._read_response(cmd, timeout, prompt)
+            except GSMError:
+                metrics.inc('gsm_errors_total')
+                raise
+
+    def _read_response(self, cmd, timeout, prompt=False):
+        deadline = time.monotonic() + timeout
+        lines = []
+
+        while True:
+            line = self._readline(deadline, prompt)
+            if line is None:
+                raise GSMError(f'{cmd}: no response in {timeout} s')
+            if line == '>':
+                return lines
+            if not line or line == cmd:
+                # Empty line or command echo
+                continue
+            if self._unsolicited(line):
+                continue
+            if line == RESULT_OK:
+                return lines
+            if line.startswith(RESULT_ERRORS):
+                raise GSMError(f'{cmd}: {line}')
+            lines.append(line)
+
+    def _readline(self, deadline, prompt=False):
+        """
+        Returns the next line received from the modem without the line
+        ending or None if the deadline passes before a full line arrives.
+        If 'prompt' is True the '>' prompt is returned as its own line.
+        """
+        while b'\n' not in self._buffer:
+            if prompt and self._buffer.lstrip().startswith(PROMPT):
+                # The prompt is not terminated with a line ending
+                self._buffer = b''
+                return '>'
+            if time.monotonic() >= deadline:
+                return None
+            self._buffer += self.ser.read(self.ser.in_waiting or 1)
+
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line.decode(errors='replace').strip()
+
+    def _unsolicited(self, line):
+        """
+        Stores the index of a new message notification.
+        Returns True if the line was an unsolicited result code.
+        """
+        if not line.startswith(NEW_MESSAGE_URC):
+            return False
+        try:
+            self._new_indices.append(int(line.rsplit(',', 1)[1]))
+        except (IndexError, ValueError):
+            print('invalid notification:', line)
+        return True
+
+    def enable_new_message_indications(self):
+        """
+        Makes the modem store received messages and notify
+        about them with +CMTI instead of waiting to be polled.
+        """
+        self.command('AT+CNMI=2,1,0,0,0')
+
+    def _read_pending(self):
+        """
+        Stores the notifications received so far without waiting. The
+        indices are kept for read_unsolicited.
+        """
+        while self.ser.in_waiting:
+            self._buffer += self.ser.read(self.ser.in_waiting)
+        while b'\n' in self._buffer:
+            line = self._readline(time.monotonic())
+            if line and not self._unsolicited(line):
+                print('unexpected data from modem:', line)
+
+    def read_unsolicited(self, timeout):
+        """
+        Reads notifications for up to 'timeout' seconds and returns the
+        storage indices of new messages as soon as there are any.
+        """
+        deadline = time.monotonic() + timeout
+        while not self._new_indices:
+            if not self.ser.in_waiting and time.monotonic() >= deadline:
+                break
+            line = self._readline(deadline)
+            if line is None:
+                break
+            if line and not self._unsolicited(line):
+                print('unexpected data from modem:', line)
+
+        indices = self._new_indices
+        self._new_indices = []
+        return indices
+
+    def read_message(self, index):
+        """
+        Returns the message stored at 'index' or None if there is none.
+
+        The message is read in PDU mode, so its text cannot be mistaken
+        for the result code of the command.
+        """
+        self._set_format(PDU_MODE)
+        lines = self.command(f'AT+CMGR={index}', timeout=5)
+        if len(lines) < 2 or not lines[0].startswith('+CMGR: '):
+            return None
+
+        try:
+            sms = parse_pdu(lines[0][len('+CMGR: '):], lines[1],
+                            indexed=False)
+        except ValueError as e:
+            print('invalid message:', e)
+            return None
+
+        sms.mid = index
+        return sms
+
+    def delete_message(self, index):
+        """
+        Deletes the message stored at 'index'.
+        """
+        self.command(f'AT+CMGD={index}', timeout=5)
+
+    def delete_messages(self, indices=None):
+        """
+        Deletes the messages stored at 'indices' or all messages stored
+        on the GSM module if 'indices' is None.
+
+        The deletions are chained into as few command lines as possible.
+        """
+        if indices is None:
+            self.command('AT+CMGD=1,4', timeout=5)
+            return
+
+        cmd = ''
+        for index in sorted(set(indices)):
+            part = f'+CMGD={index}'
+            if cmd and len(cmd) + len(part) + 1 > MAX_COMMAND_LENGTH:
+                self.command(cmd, timeout=5)
+                cmd = ''
+            cmd = cmd + ';' + part if cmd else 'AT' + part
+        if cmd:
+            self.command(cmd, timeout=5)
+
+    def _set_format(self, mode):
+        """
+        Selects PDU_MODE or TEXT_MODE unless it is already in use.
+        """
+        if self._format != mode:
+            self._format = None
+            self.command(f'AT+CMGF={mode}')
+            self._format = mode
 
     def send_message(self, to, message):
         """
         Sends a message to the phone number 'to'.
 
-        If the message is longer than 153 characters
-        the message will be split and sent as separate messages.
+        The message is sent in PDU mode. If it does not fit in one SMS
+        it is sent as a concatenated message which the receiving phone
+        shows as one message. See sms_pdu for the part sizes.
 
-        Note: takes about 5 seconds to send one message.
+        Returns the number of parts when the modem has confirmed all of
+        them, raises GSMError if the modem rejects a part and
+        InvalidNumberError if 'to' is not a phone number.
 
         """
-        self.ser.write('AT\n'.encode())
-        time.sleep(1)
-        self.ser.write('AT+CMGF=1\n'.encode())
-        time.sleep(1)
-        self.ser.write(f'AT+CMGS=\"{to}\"\n'.encode())
-        time.sleep(1)
-        self.ser.write(message.encode())
-        time.sleep(1)
-        self.ser.write(b"\x1a\n")  # Send
-        time.sleep(5)
-        self.ser.flushInput()
-        time.sleep(1)
+        try:
+            pdus = sms_pdu.encode_submit(to, message, ref=self._concat_ref)
+        except ValueError as e:
+            raise InvalidNumberError(str(e))
+        self._concat_ref = (self._concat_ref + 1) % 256
+
+        self._set_format(PDU_MODE)
+        # The whole send including the wait for the network
+        with metrics.timer('sms_send_seconds'):
+            for pdu, length in pdus:
+                self.command(f'AT+CMGS={length}', timeout=5, prompt=True)
+                try:
+                    self.ser.write(pdu.encode() + b"\x1a")  # Send
+                    self._read_response('AT+CMGS', timeout=60)
+                except GSMError:
+                    metrics.inc('gsm_errors_total')
+                    # Leave the text input mode if the modem is still in it
+                    self.ser.write(b"\x1b")
+                    raise
+        return len(pdus)
 
-    def get_messages(self):
+    def _expect(self, cmd, prefix, timeout):
         """
-        Returns a list of available SMS messages.
+        Reads lines until one starting with 'prefix' arrives and returns it.
+        Raises GSMError on an error result code or when 'timeout' passes.
         """
+        deadline = time.monotonic() + timeout
+        while True:
+            line = self._readline(deadline)
+            if line is None:
+                raise GSMError(f'{cmd}: no {prefix} in {timeout} s')
+            if line.startswith(prefix):
+                return line
+            if line.startswith(RESULT_ERRORS):
+                raise GSMError(f'{cmd}: {line}')
+            if line and line != RESULT_OK and not self._unsolicited(line):
+                print('unexpected data from modem:', line)
 
-        self.ser.flushInput()
-        time.sleep(1)
-        self.ser.write('AT\n'.encode())
-        time.sleep(1)
-        sms_list = []
+    def open_bearer(self, apn):
+        """
+        Opens the GPRS bearer used for HTTP unless it is already open.
+        """
+        lines = self.command(f'AT+SAPBR=2,{BEARER_CID}')
+        if lines and lines[0].startswith(f'+SAPBR: {BEARER_CID},1'):
+            return
+
+        self.command(f'AT+SAPBR=3,{BEARER_CID},"Contype","GPRS"')
+        self.command(f'AT+SAPBR=3,{BEARER_CID},"APN","{apn}"')
+        self.command(f'AT+SAPBR=1,{BEARER_CID}', timeout=85)
+
+    def http_post(self, url, data, content_type='application/octet-stream',
+                  headers=None, timeout=60):
+        """
+        POSTs the bytes 'data' to 'url' over the open bearer and returns
+        the HTTP status code. 'headers' {name: value} are sent in addition
+        to the content type. Raises GSMError if the request fails.
+        """
+        try:
+            # A session left open by an interrupted request
+            self.command('AT+HTTPTERM')
+        except GSMError:
+            pass
+
+        self.command('AT+HTTPINIT')
         try:
-            self.ser.write('AT+CMGL=\"ALL\"\n'.encode())
-            time.sleep(2)
-            data = self.ser.read(self.ser.inWaiting()).decode()
-
-            time.sleep(2)
-            # String operations
-            _, messages = data.split('AT+CMGL="ALL"')
-            messages = messages.replace('\n', '')
-            messages = messages.replace('\r', '')
-            messages = messages[:-2]  # Remove OK from the end
-            messages = messages.split('+CMGL: ')
-
-            for message in messages:
-                if not message:
-                    continue
-                # More string operations...
-                parts = message.split(',')
-                idx = int(parts[0])
-                status = parts[1].replace('"', '')
-                sender = parts[2].replace('"', '')
-                date = parts[4].replace('"', '')
-                mtime = parts[5].split('"')[0]
-                body = message.split(',', 1)[1]
-                _, body = body.rsplit('"', 1)
-
-                sms = SMS(mid=idx, status=status, number=sender,
-                          date=date, mtime=mtime, body=body)
-                sms_list.append(sms)
-            return sms_list
-        except (IndexError, ValueError, UnicodeDecodeError):
-            print(data)
-            return sms_list
+            self.command(f'AT+HTTPPARA="CID",{BEARER_CID}')
+            self.command(f'AT+HTTPPARA="URL","{url}"')
+            self.command(f'AT+HTTPPARA="CONTENT","{content_type}"')
+            if headers:
+                user_data = '\\r\\n'.join(f'{name}: {value}'
+                                          for name, value in headers.items())
+                self.command(f'AT+HTTPPARA="USERDATA","{user_data}"')
+
+            cmd = f'AT+HTTPDATA={len(data)},{timeout * 1000}'
+            self._read_pending()
+            self.ser.write((cmd + '\r').encode())
+            self._expect(cmd, DOWNLOAD, timeout=5)
+            self.ser.write(data)
+            self._read_response(cmd, timeout)
+
+            # The result usually arrives after OK but may come before it
+            lines = self.command('AT+HTTPACTION=1')
+            results = [line for line in lines
+                       if line.startswith(HTTP_ACTION_URC)]
+            line = results[0] if results else \
+                self._expect('AT+HTTPACTION', HTTP_ACTION_URC, timeout)
+            try:
+                return int(line.split(',')[1])
+            except (IndexError, ValueError):
+                raise GSMError(f'invalid HTTP result: {line}')
+        finally:
+            self.command('AT+HTTPTERM')
+
+    def get_messages(self, status='REC UNREAD', timeout=10):
+        """
+        Returns a list of SMS messages with 'status' ('REC UNREAD',
+        'REC READ' or 'ALL'). Listed unread messages are marked as read.
+
+        The messages are listed in PDU mode and the listing is parsed
+        while it is being received, 'timeout' is the longest allowed pause
+        in the data from the modem.
+        """
+        self._set_format(PDU_MODE)
+        with metrics.timer('sms_list_seconds'):
+            try:
+                return self._list_messages(status, timeout)
+            except GSMError:
+                metrics.inc('gsm_errors_total')
+                raise
+
+    def _list_messages(self, status, timeout):
+        sms_list = []
+        self._read_pending()
+
+        cmd = f'AT+CMGL={STATUS_CODES[status]}'
+        self.ser.write((cmd + '\r').encode())
+
+        parser = MessageListParser()
+        data = self._buffer
+        self._buffer = b''
+        deadline = time.monotonic() + timeout
+        while parser.result is None:
+            if data:
+                sms_list.extend(parser.feed(data))
+                deadline = time.monotonic() + timeout
+            elif time.monotonic() >= deadline:
+                raise GSMError(f'{cmd}: no response in {timeout} s')
+            data = self.ser.read(self.ser.in_waiting or 1)
+
+        # Notifications received after the listing are handled later
+        self._buffer = parser.remaining()
+        for line in parser.unsolicited:
+            self._unsolicited(line)
+        if parser.result != RESULT_OK:
+            raise GSMError(f'{cmd}: {parser.result}')
+
+        return sms_list
 
 
 if __name__ == '__main__':
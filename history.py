@@ -0,0 +1,336 @@
+import bisect
+import json
+import os
+from dataclasses import dataclass
+from datetime import datetime
+
+import numpy as np
+
+from binary_log import BinaryLog, HEADER, RECORD_DTYPE
+from compression import open_log, parse_record, uncompressed_name
+
+
+"""
+Time range queries over the log files written by DataLogger.
+
+Text log files are indexed in blocks of BLOCK_SIZE records. For every
+block the index stores its byte offset, first and last time and the
+count, sum, min and max of both variables. A query binary searches the
+blocks, takes the fully covered blocks from the index and reads only the
+two partially covered blocks at the ends of the range. The index is
+extended incrementally as the files grow and cached in INDEX_FILE.
+
+Binary log files need no index, their time column is searched directly
+from the memory mapped file.
+
+Log files compressed by LogCompressor (.gz) are read as streams. Their
+index is kept under the uncompressed file name, so of a file compressed
+after it was indexed only the records appended after the indexed part
+are read.
+
+Usage:
+
+    index = LogIndex('./log_data')
+    summary = index.query(parse_time('20221030'), parse_time('20221101'))
+    print(summary.count, summary.temperature_max)
+"""
+
+
+BLOCK_SIZE = 256
+INDEX_FILE = 'history_index.json'
+
+# Accepted formats for query times
+TIME_FORMATS = ('%Y%m%d_%H%M%S', '%Y%m%d_%H%M', '%Y%m%d')
+
+
+def parse_time(text):
+    """
+    Returns the epoch time of a time given as YYYYMMDD, YYYYMMDD_HHMM
+    or YYYYMMDD_HHMMSS in local time. Raises ValueError if invalid.
+    """
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.strptime(text.strip(), fmt).timestamp()
+        except ValueError:
+            pass
+    raise ValueError(f'Invalid time: {text}')
+
+
+@dataclass
+class Summary:
+    count: int = 0
+    first: float = None  # epoch time of the first record
+    last: float = None
+    temperature_min: float = None
+    temperature_max: float = None
+    temperature_sum: float = 0.0
+    humidity_min: float = None
+    humidity_max: float = None
+    humidity_sum: float = 0.0
+
+    @property
+    def temperature_mean(self):
+        return self.temperature_sum / self.count if self.count else None
+
+    @property
+    def humidity_mean(self):
+        return self.humidity_sum / self.count if self.count else None
+
+    def add(self, t, temp, hum):
+        self.merge(Summary(1, t, t, temp, temp, temp, hum, hum, hum))
+
+    def add_arrays(self, times, temps, hums):
+        if len(times):
+            self.merge(Summary(len(times), float(times[0]), float(times[-1]),
+                               float(temps.min()), float(temps.max()),
+                               float(temps.sum(dtype=np.float64)),
+                               float(hums.min()), float(hums.max()),
+                               float(hums.sum(dtype=np.float64))))
+
+    def merge(self, other):
+        if not other.count:
+            return
+        if not self.count:
+            self.__dict__.update(other.__dict__)
+            return
+
+        self.count += other.count
+        self.first = min(self.first, other.first)
+        self.last = max(self.last, other.last)
+        self.temperature_min = min(self.temperature_min, other.temperature_min)
+        self.temperature_max = max(self.temperature_max, other.temperature_max)
+        self.temperature_sum += other.temperature_sum
+        self.humidity_min = min(self.humidity_min, other.humidity_min)
+        self.humidity_max = max(self.humidity_max, other.humidity_max)
+        self.humidity_sum += other.humidity_sum
+
+
+class FileIndex:
+    """
+    Block index of one text log file.
+
+    blocks: list of [offset, Summary] in file order
+    size: bytes of the file indexed so far (complete lines only)
+    complete: the compressed file has been indexed to its end
+    """
+
+    def __init__(self, size=0, blocks=None, complete=False):
+        self.size = size
+        self.blocks = blocks if blocks is not None else []
+        self.complete = complete
+
+    @property
+    def first(self):
+        return self.blocks[0][1].first if self.blocks else None
+
+    @property
+    def last(self):
+        return self.blocks[-1][1].last if self.blocks else None
+
+    def update(self, fpath):
+        """
+        Indexes the lines appended to the file since the last update.
+        """
+        if fpath.endswith('.gz'):
+            # Compressed files are closed and do not grow. A file indexed
+            # before it was compressed is indexed on from where it was left
+            if self.complete:
+                return False
+            self.complete = True
+        else:
+            size = os.path.getsize(fpath)
+            if size < self.size:
+                # File has been rewritten
+                self.size = 0
+                self.blocks = []
+            elif size == self.size:
+                return False
+
+        with open_log(fpath) as f:
+            f.seek(self.size)
+            if self.size == 0:
+                # Header line
+                self.size += len(f.readline())
+
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Partially written line, indexed at the next update
+                    break
+                try:
+                    record = parse_record(line.decode())
+                except ValueError:
+                    record = None
+
+                if record is not None:
+                    if not self.blocks or self.blocks[-1][1].count >= BLOCK_SIZE:
+                        self.blocks.append([self.size, Summary()])
+                    self.blocks[-1][1].add(*record)
+                self.size += len(line)
+        return True
+
+    def query(self, fpath, start, end, summary):
+        """
+        Adds the records of the file between 'start' and 'end' to 'summary'.
+        """
+        if not self.blocks or self.last < start or self.first > end:
+            return
+
+        # First block that may contain records at or after 'start'
+        i = bisect.bisect_left(self.blocks, start, key=lambda b: b[1].last)
+
+        # A block ends where the next one starts. Malformed lines take
+        # space in a block without being counted in it
+        block_ends = [offset for offset, _ in self.blocks[i + 1:]] + \
+            [self.size]
+
+        with open_log(fpath) as f:
+            for (offset, block), block_end in zip(self.blocks[i:],
+                                                  block_ends):
+                if block.first > end:
+                    break
+                if start <= block.first and block.last <= end:
+                    summary.merge(block)
+                    continue
+
+                # Partially covered block
+                f.seek(offset)
+                while offset < block_end:
+                    line = f.readline()
+                    if not line:
+                        break
+                    offset += len(line)
+                    try:
+                        t, temp, hum = parse_record(line.decode())
+                    except ValueError:
+                        continue
+                    if start <= t <= end:
+                        summary.add(t, temp, hum)
+
+    def to_json(self):
+        return {'size': self.size,
+                'blocks': [[offset, block.__dict__] for offset, block
+                           in self.blocks],
+                'complete': self.complete}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['size'], [[offset, Summary(**block)] for offset, block
+                                  in data['blocks']],
+                   data.get('complete', False))
+
+
+def log_files(directory):
+    """
+    Returns the paths of the text and binary log files in 'directory'.
+    """
+    names = os.listdir(directory)
+    text = sorted(n for n in names if n.endswith(('.txt', '.txt.gz')))
+    binary = sorted(n for n in names if n.endswith(('.bin', '.bin.gz')))
+
+    # When both formats are written the binary file is used
+    stems = {uncompressed_name(n)[:-len('.bin')] for n in binary}
+    text = [n for n in text if uncompressed_name(n)[:-len('.txt')]
+            not in stems]
+    return ([os.path.join(directory, n) for n in text],
+            [os.path.join(directory, n) for n in binary])
+
+
+class LogIndex:
+    def __init__(self, directory='./log_data'):
+        self.directory = directory
+        self.index_fpath = os.path.join(directory, INDEX_FILE)
+        self.files = {}  # file name -> FileIndex
+
+        try:
+            with open(self.index_fpath, 'r') as f:
+                self.files = {name: FileIndex.from_json(data)
+                              for name, data in json.load(f).items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            # Missing or broken cache, the index is rebuilt
+            self.files = {}
+
+    def refresh(self):
+        """
+        Updates the index of the text log files and saves it if changed.
+        """
+        text, _ = log_files(self.directory)
+        names = {os.path.basename(uncompressed_name(fpath)): fpath
+                 for fpath in text}
+
+        changed = False
+        for name in list(self.files):
+            if name not in names:
+                del self.files[name]
+                changed = True
+
+        for name, fpath in names.items():
+            file_index = self.files.setdefault(name, FileIndex())
+            if file_index.update(_existing(fpath)):
+                changed = True
+
+        if changed:
+            tmp_fpath = self.index_fpath + '.tmp'
+            with open(tmp_fpath, 'w') as f:
+                json.dump({name: file_index.to_json() for name, file_index
+                           in self.files.items()}, f, separators=(',', ':'))
+            os.replace(tmp_fpath, self.index_fpath)
+
+    def query(self, start, end):
+        """
+        Returns a Summary of the logged records between the epoch
+        times 'start' and 'end'.
+        """
+        self.refresh()
+        summary = Summary()
+
+        text, binary = log_files(self.directory)
+        for fpath in text:
+            name = os.path.basename(uncompressed_name(fpath))
+            self.files[name].query(_existing(fpath), start, end, summary)
+
+        for fpath in map(_existing, binary):
+            if fpath.endswith('.gz'):
+                _query_binary_stream(fpath, start, end, summary)
+                continue
+
+            with BinaryLog(fpath) as log:
+                times = log.time
+                lo = np.searchsorted(times, start, side='left')
+                hi = np.searchsorted(times, end, side='right')
+                summary.add_arrays(times[lo:hi], log.temperature[lo:hi],
+                                   log.humidity[lo:hi])
+                del times
+
+        return summary
+
+
+def _existing(fpath):
+    """
+    Returns the path of the compressed file if 'fpath' has been
+    compressed after the directory was listed.
+    """
+    if not fpath.endswith('.gz') and not os.path.exists(fpath):
+        return fpath + '.gz'
+    return fpath
+
+
+def _query_binary_stream(fpath, start, end, summary, chunk_records=4096):
+    """
+    Adds the records of a compressed binary log between 'start' and 'end'
+    to 'summary', reading the file in chunks.
+    """
+    with open_log(fpath) as f:
+        f.read(HEADER.size)
+        while True:
+            data = f.read(RECORD_DTYPE.itemsize * chunk_records)
+            count = len(data) // RECORD_DTYPE.itemsize
+            if not count:
+                return
+
+            records = np.frombuffer(data, dtype=RECORD_DTYPE, count=count)
+            times = records['time']
+            if times[0] > end:
+                return
+            selected = records[(times >= start) & (times <= end)]
+            summary.add_arrays(selected['time'], selected['temperature'],
+                               selected['humidity'])
@@ -0,0 +1,102 @@
+import os
+import time
+
+import metrics
+
+
+"""
+Buffered writer for the log data files.
+
+Records are collected in memory and written to the open file as one
+group when 'flush_count' records are waiting or the oldest waiting record
+is 'flush_seconds' old. 'fsync' selects when the written data is forced
+to the SD card:
+
+    'none'   - never, the operating system decides
+    'close'  - when the file is closed (day rollover, new log file, exit)
+    'commit' - after every group of records
+
+Usage:
+
+    writer = LogWriter('log_data/20221030_121212.txt', header='time\tvalue\n')
+    writer.write('20221030_121300\t1.0\n')
+    writer.close()
+"""
+
+
+FSYNC_LEVELS = ('none', 'close', 'commit')
+
+
+class LogWriter:
+    def __init__(self, fpath, header=None, flush_count=10, flush_seconds=300,
+                 fsync='commit', mode='w'):
+        if fsync not in FSYNC_LEVELS:
+            raise ValueError(f'Unknown fsync level: {fsync}')
+
+        self.fpath = fpath
+        self.flush_count = max(1, flush_count)
+        self.flush_seconds = flush_seconds
+        self.fsync = fsync
+
+        if mode.startswith('a'):
+            self._repair_tail(fpath)
+
+        self._file = open(fpath, mode)
+        self._join = b''.join if 'b' in mode else ''.join
+        self._pending = []
+        self._oldest = None  # time.monotonic() of the oldest pending record
+
+        if header is not None:
+            self._file.write(header)
+            self.flush()
+
+    # Called before appending to an existing file. A record left partially
+    # written by a crash is terminated so that the next record starts
+    # on its own line.
+    def _repair_tail(self, fpath):
+        with open(fpath, 'rb+') as f:
+            if f.seek(0, os.SEEK_END) == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+
+    def write(self, record):
+        if not self._pending:
+            self._oldest = time.monotonic()
+        self._pending.append(record)
+
+        if len(self._pending) >= self.flush_count or self._expired():
+            self.flush()
+
+    def _expired(self):
+        return self._oldest is not None and \
+            time.monotonic() - self._oldest >= self.flush_seconds
+
+    # Writes the pending records if the oldest of them has waited too long.
+    # Called periodically so that records do not wait for the next write.
+    def flush_expired(self):
+        if self._expired():
+            self.flush()
+
+    # Group commit: writes all pending records with one write call
+    def flush(self):
+        with metrics.timer('log_commit_seconds'):
+            if self._pending:
+                metrics.inc('log_records_total', len(self._pending))
+                self._file.write(self._join(self._pending))
+                self._pending = []
+                self._oldest = None
+
+            self._file.flush()
+            if self.fsync == 'commit':
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file.closed:
+            return
+
+        self.flush()
+        if self.fsync == 'close':
+            os.fsync(self._file.fileno())
+        self._file.close()
@@ -1,228 +1,456 @@
+import asyncio
+import configparser
 import schedule
 import time
+import atexit
 import os
+import platform
+import signal
 import sys
 
 from tasks import TASK_TYPE
 from data_logger import ALARM_TYPE
 from data_logger import DataLogger
-from communication import Communication
-
-
-def restart():
-    os.execl(sys.executable, sys.executable, *sys.argv)
-
-if __name__ == '__main__':
-
-    logger = DataLogger()
-    communication = Communication()
-
-    # Scheduling for sensor data logging
+from communication import Communication, PRIORITY_ALARM, PRIORITY_NOTICE
+from compression import LogCompressor
+from history import parse_time
+from profiles import ProfileRegistry
+from uploader import ModemTransport, Uploader
+import metrics
+
+
+# Logging job of each logger
+log_jobs = {}
+
+# (Re)schedule sensor data logging with the current interval of the logger.
+# The previous job is cancelled, so the interval changes without a restart.
+def schedule_logging(logger):
+    if logger in log_jobs:
+        schedule.cancel_job(log_jobs[logger])
     log_interval = logger.get_log_interval()
-    schedule.every(log_interval).minutes.at(':00').do(logger.log_data)
-    # schedule.every(10).seconds.do(logger.log_data)
-
-    # New log data file when new day starts
-    schedule.every().day.at('00:00').do(logger.create_log_file)
+    log_jobs[logger] = schedule.every(log_interval).minutes.at(':00') \
+        .do(logger.log_data)
+    return log_jobs[logger]
+
+# Rounded sensor value for messages, '-' if not measured yet
+def fmt_value(value):
+    return '-' if value is None else round(value, 2)
+
+# Loggers of the containers given as base directories on the command line
+# (fleet mode) or a single logger in the current directory
+def create_loggers(base_dirs):
+    if not base_dirs:
+        return {None: DataLogger()}
+
+    # One compressing thread and one profile registry for all containers
+    compressor = LogCompressor()
+    profiles = ProfileRegistry('./threshold_profiles')
+    loggers = {}
+    for base_dir in base_dirs:
+        name = os.path.basename(os.path.normpath(base_dir))
+        loggers[name] = DataLogger(base_dir, name=name, profiles=profiles,
+                                   compressor=compressor)
+    return loggers
+
+# The logger a command from the communication is meant for. In fleet mode
+# the message starts with '<container>:'. With a single logger a prefix
+# (for example 'Re: help') is ignored
+def select_logger(loggers, communication, task):
+    if len(loggers) == 1:
+        return next(iter(loggers.values()))
+    name = task['data'].get('logger')
+    if name in loggers:
+        return loggers[name]
+
+    communication.send_message(
+        task['data']['number'],
+        'Unknown container. Start the message with <container>: '
+        'one of ' + ', '.join(str(name) for name in loggers))
+    return None
+
+def handle_task(logger, communication, task):
+    task_params = task['data']
+
+    if task['type'] == TASK_TYPE.SEND_SENSOR_DATA:
+        target_number = task_params['number']
+
+        latest_values = logger.get_values()
+        temp = fmt_value(latest_values['temperature'])
+        hum = fmt_value(latest_values['humidity'])
+
+        ext_v = logger.get_extreme_values()
+        ext_temp_l = fmt_value(ext_v['temperature'][0])
+        ext_temp_h = fmt_value(ext_v['temperature'][1])
+        ext_hum_l = fmt_value(ext_v['humidity'][0])
+        ext_hum_h = fmt_value(ext_v['humidity'][1])
+
+        # min, max, mean of today from the aggregates
+        day = logger.get_rollup('day')
+        day_temp = [fmt_value(v) for v in day['temperature']]
+        day_hum = [fmt_value(v) for v in day['humidity']]
+
+        msg = f'Latest:\n' \
+              f'Temp: {temp} C\n' \
+              f'Hum: {hum} RH\n' \
+              f'\n' \
+              f'Extreme:\n' \
+              f'temp: {ext_temp_l} - {ext_temp_h}\n' \
+              f'hum: {ext_hum_l} - {ext_hum_h}\n' \
+              f'\n' \
+              f'Today:\n' \
+              f'temp: {day_temp[0]} - {day_temp[1]}, mean {day_temp[2]}\n' \
+              f'hum: {day_hum[0]} - {day_hum[1]}, mean {day_hum[2]}\n'
+
+        communication.send_message(target_number, msg)
+        print('sending:')
+        print(msg)
+
+    elif task['type'] == TASK_TYPE.SEND_ALARM_STATE:
+        target_number = task_params['number']
+
+        msg = 'Alarms:\n'
+        for channel, (low, high) in logger.get_alarms().items():
+            if low:
+                msg += f'Low {channel}\n'
+            elif high:
+                msg += f'High {channel}\n'
+
+        communication.send_message(target_number, msg)
+        print(msg)
+
+    elif task['type'] == TASK_TYPE.SEND_LOGGER_STATE:
+        target_number = task_params['number']
+
+        thresholds = logger.get_thresholds()
+        profile_name = thresholds['profile_name']
+        min_temp = thresholds['temperature'][0]
+        max_temp = thresholds['temperature'][1]
+        min_hum = thresholds['humidity'][0]
+        max_hum = thresholds['humidity'][1]
+
+        log_interval = logger.get_log_interval()
+
+        num_str = ''
+        for num in logger.alarm_numbers:
+            num_str += num + '\n'
+
+        msg = f'Profile:\n' \
+              f'{profile_name}\n' \
+              f'Temp range: {min_temp} - {max_temp}\n' \
+              f'Hum range: {min_hum} - {max_hum}\n' \
+              f'\n' \
+              f'log interval: {log_interval} min\n' \
+              f'\n' \
+              f'Alarm receivers:\n' \
+              f'{num_str}' \
+
+        communication.send_message(target_number, msg)
+        print(msg)
+
+    elif task['type'] == TASK_TYPE.SEND_PROFILES:
+        target_number = task_params['number']
+
+        msg = 'Existing threshold profiles: \n'
+        for profile in logger.get_threshold_profiles():
+            print(profile)
+            msg += profile + '\n'
+
+        communication.send_message(target_number, msg)
+        print(msg)
+
+    elif task['type'] == TASK_TYPE.SET_PROFILE:
+        target_number = task_params['number']
+        profile = task_params['profile']
+        ret = None
+        try:
+            logger.use_threshold_profile(profile)
+            ret = True
+        except ValueError:
+            ret = False
+
+        if ret:
+            msg = f'Used profile changed to {profile}'
+        else:
+            msg = 'Changing profile failed'
+
+        communication.send_message(target_number, msg)
+        print(msg)
+
+    elif task['type'] == TASK_TYPE.SET_LOGGING_INTERVAL:
+        target_number = task_params['number']
+        interval = task_params['interval']
+
+        ret = logger.set_log_interval(interval)
+
+        if ret:
+            schedule_logging(logger)
+            msg = f'Logging interval changed to {interval} min'
+        else:
+            msg = 'Changing logging interval failed'
+
+        communication.send_message(target_number, msg)
+        print(msg)
+
+    elif task['type'] == TASK_TYPE.NEW_LOG_FILE:
+        target_number = task_params['number']
+        timestamp = logger.create_log_file()
+
+        msg = f'Created new log file with timestamp {timestamp}'
+
+        communication.send_message(target_number, msg)
+        print(msg)
+
+    elif task['type'] == TASK_TYPE.SET_NUMBER:
+        target_number = task_params['number']
+        logger.add_number(target_number)
+        msg = f'Number {target_number} is added to alarm number list'
+
+        communication.send_message(target_number, msg)
+        print(msg)
+
+    elif task['type'] == TASK_TYPE.REMOVE_NUMBER:
+        target_number = task_params['number']
+
+        ret = logger.remove_number(target_number)
+        if ret:
+            msg = f'Number {target_number} is removed from alarm number list'
+        else:
+            msg = f'Number {target_number} was not found in the alarm number list'
+
+        communication.send_message(target_number, msg)
+        print(msg)
+
+    elif task['type'] == TASK_TYPE.HELP:
+        target_number = task_params['number']
+
+        with open('help.txt', 'r') as help_file:
+            msg = help_file.read()
+
+        communication.send_message(target_number, msg)
+        print(msg)
+
+    elif task['type'] == TASK_TYPE.SEND_HISTORY:
+        target_number = task_params['number']
+
+        try:
+            start = parse_time(task_params['start'])
+            end = parse_time(task_params['end']) \
+                if task_params['end'] else time.time()
+        except ValueError:
+            start = end = None
+
+        if start is None:
+            msg = 'Invalid time. Use YYYYMMDD or YYYYMMDD_HHMM'
+        else:
+            summary = logger.get_history(start, end)
+            if summary.count:
+                first = time.strftime('%d.%m. %H:%M',
+                                      time.localtime(summary.first))
+                last = time.strftime('%d.%m. %H:%M',
+                                     time.localtime(summary.last))
+                msg = f'History {first} - {last}\n' \
+                      f'samples: {summary.count}\n' \
+                      f'temp: {round(summary.temperature_min, 2)} - ' \
+                      f'{round(summary.temperature_max, 2)}, ' \
+                      f'mean {round(summary.temperature_mean, 2)}\n' \
+                      f'hum: {round(summary.humidity_min, 2)} - ' \
+                      f'{round(summary.humidity_max, 2)}, ' \
+                      f'mean {round(summary.humidity_mean, 2)}\n'
+            else:
+                msg = 'No logged data in the given time range'
+
+        communication.send_message(target_number, msg)
+        print(msg)
+
+    elif task['type'] == TASK_TYPE.RELOAD_SETTINGS:
+        target_number = task_params['number']
+
+        # Apply the settings file without restarting the program
+        try:
+            logger.reload_settings()
+            schedule_logging(logger)
+            msg = 'Settings reloaded'
+        except ValueError as e:
+            msg = f'Reloading settings failed: {e}'
+
+        communication.send_message(target_number, msg)
+        print(msg)
+
+    elif task['type'] == TASK_TYPE.SEND_STATS:
+        target_number = task_params['number']
+
+        msg = metrics.summary()
+
+        communication.send_message(target_number, msg)
+        print(msg)
+
+    elif task['type'] == TASK_TYPE.SEND_ALARM:
+        target_numbers = task_params['numbers']
+
+        # One line per alarm of the digest,
+        # for example 'High temperature 8.4 since 12:03'
+        lines = []
+        priority = PRIORITY_NOTICE
+        for variable, type, value, since in task_params['events']:
+            if type == ALARM_TYPE.LOW:
+                line = f'Low {variable} {fmt_value(value)}'
+                priority = PRIORITY_ALARM
+            elif type == ALARM_TYPE.HIGH:
+                line = f'High {variable} {fmt_value(value)}'
+                priority = PRIORITY_ALARM
+            elif type == ALARM_TYPE.NORMAL:
+                line = f'{variable} back in the normal range'
+            since = time.strftime('%H:%M', time.localtime(since))
+            lines.append(f'{line} since {since}')
+
+        msg = '\n'.join(lines)
+        if priority == PRIORITY_ALARM:
+            msg = 'ALARM!:\n' + msg
+        if logger.name is not None:
+            msg = f'{logger.name}: {msg}'
+
+        for num in target_numbers:
+            communication.send_message(num, msg, priority)
+        print(msg)
+
+# Uploaders of the loggers with an upload_url in their settings. The
+# uploads go over the modem between the SMS messages
+def create_uploaders(loggers, communication):
+    uploaders = []
+    for logger in loggers.values():
+        settings = logger.settings['DEFAULT']
+        url = settings.get('upload_url', fallback='')
+        if not url:
+            continue
+        transport = ModemTransport(
+            communication, settings.get('upload_apn', fallback='internet'))
+        uploaders.append(Uploader(
+            logger.log_dir, url, transport,
+            batch_records=settings.getint('upload_batch', fallback=500),
+            interval=settings.getint('upload_interval', fallback=600),
+            name=logger.name or platform.node()))
+    return uploaders
+
+# Enable the metrics and their periodic export if set in the settings
+def setup_metrics():
+    settings = configparser.ConfigParser()
+    settings.read('settings.ini')
+    if not settings.getboolean('DEFAULT', 'metrics', fallback=False):
+        return
+
+    metrics.enable()
+    fpath = settings.get('DEFAULT', 'metrics_file', fallback='')
+    if fpath:
+        interval = settings.getint('DEFAULT', 'metrics_interval', fallback=60)
+        schedule.every(interval).seconds.do(metrics.export, fpath)
+
+# Restart the whole program, for example to recover from a hung modem.
+# The queued replies are sent and the loggers closed first
+def restart(loggers, communication):
+    communication.stop(timeout=60)
+    for logger in loggers.values():
+        logger.close()
+    os.execl(sys.executable, sys.executable, *sys.argv)
 
-    print(logger.get_state())
+# A failing task is reported and skipped, it must not stop the event loop
+def handle_task_safely(logger, communication, task):
+    try:
+        handle_task(logger, communication, task)
+    except Exception as e:
+        print('handling task', task['type'], 'failed:', e)
+
+# Handles the tasks of the loggers and the received commands
+def handle_tasks(loggers, communication):
+    for logger in loggers.values():
+        for task in logger.get_tasks():
+            handle_task_safely(logger, communication, task)
+
+    for task in communication.get_tasks():
+        if task['type'] == TASK_TYPE.SEND_STATS:
+            # Metrics of the whole process
+            handle_task_safely(None, communication, task)
+            continue
+        if task['type'] == TASK_TYPE.RESTART:
+            # Restarts all the loggers of the process
+            communication.send_message(task['data']['number'], 'Restarting')
+            restart(loggers, communication)
+
+        logger = select_logger(loggers, communication, task)
+        if logger is not None:
+            handle_task_safely(logger, communication, task)
+
+# Event loop: sleeps until the next scheduled job or alarm digest is due
+# or until a logger or the communication worker thread adds a task.
+# Received messages are checked and replies sent by the communication
+# worker thread, which blocks on the serial port. Returns on SIGTERM,
+# the loggers are then closed by their atexit handlers, which are not
+# run if the process is killed by the signal.
+async def run(loggers, communication):
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    terminated = False
+
+    def notify():
+        loop.call_soon_threadsafe(wakeup.set)
+
+    def terminate():
+        nonlocal terminated
+        terminated = True
+        wakeup.set()
+
+    loop.add_signal_handler(signal.SIGTERM, terminate)
+
+    communication.on_task = notify
+    for logger in loggers.values():
+        logger.on_task = notify
+
+    while not terminated:
+        # Cleared before handling so that a task added meanwhile
+        # wakes up the next wait
+        wakeup.clear()
 
-    while True:
         # Check scheduled tasks
         schedule.run_pending()
 
-        communication.check_recieved_messages()
-
-        # get tasks from DataLogger and communication classes
-        tasks = logger.get_tasks() + communication.get_tasks()
-
-        # handling tasks
-        for task in tasks:
-            task_params = task['data']
-
-            if task['type'] == TASK_TYPE.SEND_SENSOR_DATA:
-                target_number = task_params['number']
-
-                latest_values = logger.get_values()
-                temp = round(latest_values['temperature'], 2)
-                hum = round(latest_values['humidity'], 2)
-
-                ext_v = logger.get_extreme_values()
-                ext_temp_l = round(ext_v['temperature'][0], 2)
-                ext_temp_h = round(ext_v['temperature'][1], 2)
-                ext_hum_l = round(ext_v['humidity'][0], 2)
-                ext_hum_h = round(ext_v['humidity'][1], 2)
-
-                msg = f'Latest:\n' \
-                      f'Temp: {temp} C\n' \
-                      f'Hum: {hum} RH\n' \
-                      f'\n' \
-                      f'Extreme:\n' \
-                      f'temp: {ext_temp_l} - {ext_temp_h}\n' \
-                      f'hum: {ext_hum_l} - {ext_hum_h}\n' \
-
-
-                communication.send_message(target_number, msg)
-                print('sending:')
-                print(msg)
-
-            elif task['type'] == TASK_TYPE.SEND_ALARM_STATE:
-                target_number = task_params['number']
-
-                msg = 'Alarms:\n'
-                alarms = logger.get_alarms()
-                if alarms['temperature'][0]:
-                    msg += 'Low temperature\n'
-                elif alarms['temperature'][1]:
-                    msg += 'High temperature\n'
-
-                if alarms['humidity'][0]:
-                    msg += 'Low humidity\n'
-                elif alarms['humidity'][1]:
-                    msg += 'High humidity\n'
-
-                communication.send_message(target_number, msg)
-                print(msg)
-
-
-            elif task['type'] == TASK_TYPE.SEND_LOGGER_STATE:
-                target_number = task_params['number']
-
-                thresholds = logger.get_thresholds()
-                profile_name = thresholds['profile_name']
-                min_temp = thresholds['temperature'][0]
-                max_temp = thresholds['temperature'][1]
-                min_hum = thresholds['humidity'][0]
-                max_hum = thresholds['humidity'][1]
-
-                log_interval = logger.get_log_interval()
-
-                num_str = ''
-                for num in logger.alarm_numbers:
-                    num_str += num + '\n'
-
-                msg = f'Profile:\n' \
-                      f'{profile_name}\n' \
-                      f'Temp range: {min_temp} - {max_temp}\n' \
-                      f'Hum range: {min_hum} - {max_hum}\n' \
-                      f'\n' \
-                      f'log interval: {log_interval} min\n' \
-                      f'\n' \
-                      f'Alarm receivers:\n' \
-                      f'{num_str}' \
-
-                communication.send_message(target_number, msg)
-                print(msg)
-
-            elif task['type'] == TASK_TYPE.SEND_PROFILES:
-                target_number = task_params['number']
-
-                msg = 'Existing threshold profiles: \n'
-                for profile in logger.get_threshold_profiles():
-                    print(profile)
-                    msg += profile + '\n'
-
-                communication.send_message(target_number, msg)
-                print(msg)
-
-            elif task['type'] == TASK_TYPE.SET_PROFILE:
-                target_number = task_params['number']
-                profile = task_params['profile']
-                ret = None
-                try:
-                    logger.use_threshold_profile(profile)
-                    ret = True
-                except ValueError:
-                    ret = False
+        # Debounced alarms which are due, next_due: time of the next
+        next_due = [due for due in (logger.flush_alarms()
+                                    for logger in loggers.values())
+                    if due is not None]
+
+        handle_tasks(loggers, communication)
+
+        timeout = schedule.idle_seconds()
+        if next_due:
+            alarm_timeout = min(next_due) - time.time()
+            timeout = alarm_timeout if timeout is None \
+                else min(timeout, alarm_timeout)
+        if timeout is not None:
+            timeout = max(0, timeout)
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
-                if ret:
-                    msg = f'Used profile changed to {profile}'
-                else:
-                    msg = 'Changing profile failed'
-
-                communication.send_message(target_number, msg)
-                print(msg)
-
-            elif task['type'] == TASK_TYPE.SET_LOGGING_INTERVAL:
-                target_number = task_params['number']
-                interval = task_params['interval']
-
-                ret = logger.set_log_interval(interval)
-
-                if ret:
-                    msg = f'Logging interval changed to {interval}.\n' \
-                          f'New interval will be applied after restart'
-                else:
-                    msg = 'Changing logging interval failed'
-
-                communication.send_message(target_number, msg)
-                print(msg)
-
-            elif task['type'] == TASK_TYPE.NEW_LOG_FILE:
-                target_number = task_params['number']
-                timestamp = logger.create_log_file()
-
-                msg = f'Created new log file with timestamp {timestamp}'
-
-                communication.send_message(target_number, msg)
-                print(msg)
-
-            elif task['type'] == TASK_TYPE.SET_NUMBER:
-                target_number = task_params['number']
-                logger.add_number(target_number)
-                msg = f'Number {target_number} is added to alarm number list'
-
-                communication.send_message(target_number, msg)
-                print(msg)
-
-            elif task['type'] == TASK_TYPE.REMOVE_NUMBER:
-                target_number = task_params['number']
-
-                ret = logger.remove_number(target_number)
-                if ret:
-                    msg = f'Number {target_number} is removed from alarm number list'
-                else:
-                    msg = f'Number {target_number} was not found in the alarm number list'
-
-                communication.send_message(target_number, msg)
-                print(msg)
-
-            elif task['type'] == TASK_TYPE.HELP:
-                target_number = task_params['number']
-
-                with open('help.txt', 'r') as help_file:
-                    msg = help_file.read()
-
-                communication.send_message(target_number, msg)
-                print(msg)
-
-            elif task['type'] == TASK_TYPE.RESTART:
-                restart()
-
-
-
-
-            elif task['type'] == TASK_TYPE.SEND_ALARM:
-                target_numbers = task_params['numbers']
-                variable = task_params['variable']
-                type = task_params['type']
-
-                if type == ALARM_TYPE.LOW:
-                    msg = 'ALARM!:\n' \
-                          f'Low {variable}'
+if __name__ == '__main__':
 
-                elif type == ALARM_TYPE.HIGH:
-                    msg = 'ALARM!:\n' \
-                          f'High {variable}'
+    setup_metrics()
+    loggers = create_loggers(sys.argv[1:])
+    communication = Communication()
 
-                elif type == ALARM_TYPE.NORMAL:
-                    msg = f'{variable} back in the normal range'
+    for logger in loggers.values():
+        # Scheduling for sensor data logging
+        schedule_logging(logger)
 
-                for num in target_numbers:
-                    communication.send_message(num, msg)
-                print(msg)
+        # New log data file when new day starts
+        schedule.every().day.at('00:00').do(logger.create_log_file)
 
+        # Write buffered log records which have waited for too long
+        schedule.every(logger.log_flush_seconds).seconds.do(logger.flush_log)
+        atexit.register(logger.close)
 
+        print(logger.get_state())
 
+    for uploader in create_uploaders(loggers, communication):
+        uploader.start()
 
-        #time.sleep(30)
+    asyncio.run(run(loggers, communication))
@@ -0,0 +1,184 @@
+import bisect
+import contextlib
+import os
+import threading
+import time
+
+from snapshot import save_snapshot
+
+
+"""
+Counters, gauges and timing histograms of the hot paths.
+
+Metrics are off until enable() is called. While off every call returns
+right after checking a flag, so the instrumentation can stay in place.
+
+export() writes all metrics to a file atomically: a Prometheus textfile
+(for the node exporter textfile collector) if the path ends with .prom,
+otherwise a JSON snapshot. summary() returns a short text for the
+'stats' command.
+
+Usage:
+
+    metrics.enable()
+    with metrics.timer('sensor_read_seconds'):
+        hum, temp = sensor.read()
+    metrics.inc('sms_sent_total')
+    metrics.set_gauge('outbox_messages', 3)
+    metrics.export('log_data/metrics.prom')
+"""
+
+
+# Upper bounds of the histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+enabled = False
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+
+_NULL_TIMER = contextlib.nullcontext()
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+class _Timer:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start)
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+def inc(name, value=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name, value):
+    if not enabled:
+        return
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name, value):
+    if not enabled:
+        return
+    with _lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram()
+        _histograms[name].observe(value)
+
+
+def timer(name):
+    """
+    Context manager observing the seconds spent inside it
+    into histogram 'name'.
+    """
+    if not enabled:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def snapshot():
+    """
+    Returns all metrics as a JSON compatible dict.
+    """
+    with _lock:
+        return {'time': time.time(),
+                'counters': dict(_counters),
+                'gauges': dict(_gauges),
+                'histograms': {
+                    name: {'count': h.count, 'sum': h.sum, 'max': h.max,
+                           'buckets': dict(zip(
+                               [str(b) for b in h.buckets] + ['+Inf'],
+                               h.counts))}
+                    for name, h in _histograms.items()}}
+
+
+def to_prometheus(data):
+    lines = []
+    for name, value in sorted(data['counters'].items()):
+        lines += [f'# TYPE {name} counter', f'{name} {value}']
+    for name, value in sorted(data['gauges'].items()):
+        lines += [f'# TYPE {name} gauge', f'{name} {value}']
+    for name, h in sorted(data['histograms'].items()):
+        lines.append(f'# TYPE {name} histogram')
+        cumulative = 0
+        for bound, count in h['buckets'].items():
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines += [f'{name}_sum {h["sum"]}', f'{name}_count {h["count"]}']
+    return '\n'.join(lines) + '\n'
+
+
+def export(fpath):
+    """
+    Writes the metrics to 'fpath' atomically, in the Prometheus text
+    format if it ends with .prom and as JSON otherwise.
+    """
+    if not enabled:
+        return
+    data = snapshot()
+    if not fpath.endswith('.prom'):
+        save_snapshot(fpath, data)
+        return
+
+    tmp_fpath = fpath + '.tmp'
+    with open(tmp_fpath, 'w') as f:
+        f.write(to_prometheus(data))
+    os.replace(tmp_fpath, fpath)
+
+
+def summary():
+    """
+    Short text of the metrics for a message.
+    """
+    if not enabled:
+        return 'Metrics are disabled'
+
+    data = snapshot()
+    lines = [f'{name}: {value}'
+             for name, value in sorted(data['counters'].items())]
+    lines += [f'{name}: {value}'
+              for name, value in sorted(data['gauges'].items())]
+    for name, h in sorted(data['histograms'].items()):
+        if h['count']:
+            mean = h['sum'] / h['count']
+            lines.append(f'{name}: n {h["count"]}, mean {mean * 1000:.1f} ms, '
+                         f'max {h["max"] * 1000:.1f} ms')
+    return '\n'.join(lines) if lines else 'No metrics yet'
@@ -0,0 +1,144 @@
+import math
+import sqlite3
+import threading
+import time
+
+
+"""
+Durable queue of outbound SMS messages.
+
+Messages are stored in an SQLite database in WAL mode, so messages
+queued before a crash, a restart or a stretch without signal are sent
+after it. A message is removed only after the modem has confirmed it
+(at least once delivery). A failed send is retried with exponential
+backoff.
+
+Messages are taken in the order (priority, deadline, id). Deadlines are
+epoch times; a message not sent by its deadline is dropped.
+Messages without a deadline come last in their priority.
+
+Usage:
+
+    outbox = Outbox('log_data/outbox.db')
+    outbox.put('+358...', 'ALARM!', priority=0)
+    outbox.drop_expired()
+    for mid, number, message, attempts in outbox.due(limit=10):
+        if send(number, message):
+            outbox.ack(mid)
+        else:
+            outbox.retry(mid, attempts)
+"""
+
+
+# Seconds before the first retry, doubled for every failed attempt
+RETRY_DELAY = 10
+MAX_RETRY_DELAY = 900
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    number TEXT NOT NULL,
+    message TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    deadline REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS outbox_order
+    ON outbox (priority, deadline, id);
+'''
+
+
+class Outbox:
+    def __init__(self, fpath):
+        self.fpath = fpath
+        # Used from the main and the communication threads
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(fpath, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # A queued alarm must survive a power cut
+        self._db.execute('PRAGMA synchronous=FULL')
+        self._db.executescript(_SCHEMA)
+
+    def put(self, number, message, priority, deadline=None):
+        """
+        Stores a message, returns its id.
+        """
+        if deadline is None:
+            deadline = math.inf
+        with self._lock:
+            cursor = self._db.execute(
+                'INSERT INTO outbox (number, message, priority, deadline) '
+                'VALUES (?, ?, ?, ?)', (number, message, priority, deadline))
+            return cursor.lastrowid
+
+    def find(self, number, message, priority):
+        """
+        Returns the id of a pending identical message or None.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT id FROM outbox WHERE number = ? AND message = ? '
+                'AND priority = ? LIMIT 1',
+                (number, message, priority)).fetchone()
+        return row[0] if row else None
+
+    def drop_expired(self, now=None):
+        """
+        Removes the messages past their deadline, returns their count.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            return self._db.execute(
+                'DELETE FROM outbox WHERE deadline < ?', (now,)).rowcount
+
+    def due(self, limit=10, now=None):
+        """
+        Returns up to 'limit' messages [(id, number, message, attempts)]
+        to send now in sending order.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            return self._db.execute(
+                'SELECT id, number, message, attempts FROM outbox '
+                'WHERE next_attempt <= ? '
+                'ORDER BY priority, deadline, id LIMIT ?',
+                (now, limit)).fetchall()
+
+    def ack(self, mid):
+        """
+        Removes a sent message.
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM outbox WHERE id = ?', (mid,))
+
+    def retry(self, mid, attempts, now=None):
+        """
+        Schedules a new attempt of a message whose sending failed.
+        """
+        now = time.time() if now is None else now
+        delay = min(RETRY_DELAY * 2 ** attempts, MAX_RETRY_DELAY)
+        with self._lock:
+            self._db.execute(
+                'UPDATE outbox SET attempts = ?, next_attempt = ? '
+                'WHERE id = ?', (attempts + 1, now + delay, mid))
+
+    def next_attempt(self):
+        """
+        Returns the epoch time when the next message can be sent,
+        None if the outbox is empty.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT MIN(next_attempt) FROM outbox').fetchone()
+        return row[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM outbox') \
+                .fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,134 @@
+import configparser
+import os
+
+
+"""
+Threshold profiles.
+
+A profile is an .ini file in the profile directory with the sections
+TEMPERATURE and HUMIDITY, each having min, max and hysteresis:
+
+    [TEMPERATURE]
+    min = 1
+    max = 6.5
+    hysteresis = 0.5
+
+ProfileRegistry loads and validates all profiles once and keeps them in
+memory. A file is parsed again only when its modification time changes
+and the directory is listed again only when the directory changes.
+Invalid profiles are rejected when they are loaded and reported in
+'errors'.
+
+Usage:
+
+    profiles = ProfileRegistry('./threshold_profiles')
+    profiles.names()         # ['fruits', 'milk']
+    profiles.get('milk')     # {'profile_name': 'milk',
+                             #  'temperature': (1.0, 6.0, 1.0), ...}
+"""
+
+
+VARIABLES = ('temperature', 'humidity')
+
+
+def load_profile(fpath):
+    """
+    Reads and validates the profile file 'fpath'. Returns
+    {variable: (min, max, hysteresis)}, raises ValueError if the profile
+    is invalid.
+    """
+    profile = configparser.ConfigParser()
+    try:
+        if not profile.read(fpath):
+            raise ValueError(f'Cannot read profile: {fpath}')
+        thresholds = {variable: tuple(profile.getfloat(variable.upper(), key)
+                                      for key in ('min', 'max', 'hysteresis'))
+                      for variable in VARIABLES}
+    except configparser.Error as e:
+        raise ValueError(f'Invalid profile {fpath}: {e}')
+
+    for variable, (low, high, hysteresis) in thresholds.items():
+        if not low < high:
+            raise ValueError(f'Invalid profile {fpath}: {variable} '
+                             f'min {low} is not below max {high}')
+        if not 0 <= hysteresis < high - low:
+            raise ValueError(f'Invalid profile {fpath}: {variable} '
+                             f'hysteresis {hysteresis} out of range')
+    return thresholds
+
+
+class ProfileRegistry:
+    def __init__(self, directory='./threshold_profiles'):
+        self.directory = directory
+
+        # name -> (mtime, thresholds) of the valid profiles
+        self._profiles = {}
+        # name -> error message of the invalid profiles
+        self.errors = {}
+        self._dir_mtime = None
+        self.refresh()
+
+    def _fpath(self, name):
+        return os.path.join(self.directory, name + '.ini')
+
+    def _load(self, name, mtime):
+        try:
+            self._profiles[name] = (mtime, load_profile(self._fpath(name)))
+            self.errors.pop(name, None)
+        except ValueError as e:
+            print('rejected threshold profile:', e)
+            self._profiles.pop(name, None)
+            self.errors[name] = str(e)
+
+    def refresh(self):
+        """
+        Loads the added and changed profiles and forgets the removed ones
+        if the directory has changed since the previous call.
+        """
+        mtime = os.stat(self.directory).st_mtime_ns
+        if mtime == self._dir_mtime:
+            return
+        self._dir_mtime = mtime
+
+        names = set()
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.ini'):
+                name = entry.name[:-len('.ini')]
+                names.add(name)
+                mtime = entry.stat().st_mtime_ns
+                if name not in self._profiles or \
+                        self._profiles[name][0] != mtime:
+                    self._load(name, mtime)
+
+        for name in set(self._profiles) - names:
+            del self._profiles[name]
+        for name in set(self.errors) - names:
+            del self.errors[name]
+
+    def names(self):
+        """
+        Returns the names of the valid profiles.
+        """
+        self.refresh()
+        return sorted(self._profiles)
+
+    def get(self, name):
+        """
+        Returns the thresholds of profile 'name' in the form
+        {'profile_name': name, variable: (min, max, hysteresis)}.
+        Raises ValueError if there is no valid profile of that name.
+        """
+        # An edited file does not always change the directory mtime
+        try:
+            mtime = os.stat(self._fpath(name)).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime is None:
+            self._profiles.pop(name, None)
+        elif name not in self._profiles or self._profiles[name][0] != mtime:
+            self._load(name, mtime)
+
+        if name not in self._profiles:
+            raise ValueError(self.errors.get(
+                name, f'Unknown threshold profile: {name}'))
+        return {'profile_name': name, **self._profiles[name][1]}
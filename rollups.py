@@ -0,0 +1,99 @@
+import os
+
+
+"""
+Hourly and daily aggregates of the logged variables.
+
+Every sample updates the count, sum, min and max of the current hour and
+day buckets in constant time. When a bucket ends it is appended to
+rollups_<period>.tsv next to the log files:
+
+    <bucket>\t<count>\t<sum>\t<min>\t<max>[\t... for the next variable]
+
+where <bucket> is YYYYmmdd_HH for hours and YYYYmmdd for days.
+The open buckets are saved with dump() and restored with load(), for
+example as part of the DataLogger state snapshot.
+
+Usage:
+
+    rollups = Rollups('./log_data')
+    rollups.add(datetime.now(), {'temperature': 4.2, 'humidity': 80.1})
+    count, total, low, high = rollups.get('day')['temperature']
+"""
+
+
+PERIODS = {'hour': '%Y%m%d_%H', 'day': '%Y%m%d'}
+
+
+class Rollups:
+    def __init__(self, directory='./log_data',
+                 variables=('temperature', 'humidity')):
+        self.directory = directory
+        self.variables = tuple(variables)
+
+        # period -> {'bucket': key, variable: [count, sum, min, max]}
+        self.current = {period: self._new_bucket(None) for period in PERIODS}
+
+    def _new_bucket(self, key):
+        bucket = {'bucket': key}
+        for variable in self.variables:
+            bucket[variable] = [0, 0.0, None, None]
+        return bucket
+
+    def add(self, dt, values, lows=None, highs=None):
+        """
+        Adds the sample 'values' {variable: value} measured at datetime 'dt'.
+        If the sample is an aggregate, 'lows' and 'highs' are the smallest
+        and largest values it was made of.
+        """
+        lows = lows or values
+        highs = highs or values
+        for period, fmt in PERIODS.items():
+            key = dt.strftime(fmt)
+            bucket = self.current[period]
+            if bucket['bucket'] != key:
+                self._close(period)
+                bucket = self.current[period] = self._new_bucket(key)
+
+            for variable in self.variables:
+                value = values[variable]
+                agg = bucket[variable]
+                agg[0] += 1
+                agg[1] += value
+                if agg[2] is None or lows[variable] < agg[2]:
+                    agg[2] = lows[variable]
+                if agg[3] is None or highs[variable] > agg[3]:
+                    agg[3] = highs[variable]
+
+    def _close(self, period):
+        bucket = self.current[period]
+        if bucket['bucket'] is None:
+            return
+
+        fields = [bucket['bucket']]
+        for variable in self.variables:
+            count, total, low, high = bucket[variable]
+            fields.append(str(count))
+            fields += [str(round(value, 4)) for value in (total, low, high)]
+        with open(os.path.join(self.directory, f'rollups_{period}.tsv'), 'a') as f:
+            f.write('\t'.join(fields) + '\n')
+
+    def get(self, period):
+        """
+        Returns the current bucket of 'period' ('hour' or 'day').
+        """
+        return self.current[period]
+
+    @staticmethod
+    def mean(aggregate):
+        count, total, _, _ = aggregate
+        return total / count if count else None
+
+    def load(self, data):
+        for period in PERIODS:
+            if period in data and \
+                    all(variable in data[period] for variable in self.variables):
+                self.current[period] = data[period]
+
+    def dump(self):
+        return self.current
@@ -0,0 +1,112 @@
+import threading
+import time
+
+import numpy as np
+
+
+"""
+High rate background sampling of the sensor.
+
+Sampler reads the sensor 'rate' times per second in its own thread into
+a RingBuffer of fixed size. Every sample is passed to 'on_sample' (for
+example alarm evaluation) and aggregate() returns the mean, min and max
+of the samples taken since the previous call.
+
+Usage:
+
+    sampler = Sampler(sensor.read, rate=1, capacity=3600,
+                      on_sample=lambda t, hum, temp: ...)
+    sampler.start()
+    stats = sampler.aggregate()  # {'temperature': (mean, min, max), ...}
+"""
+
+
+class RingBuffer:
+    """
+    Fixed size buffer of the latest (time, temperature, humidity) samples.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.time = np.zeros(capacity)
+        self.temperature = np.zeros(capacity)
+        self.humidity = np.zeros(capacity)
+        self.count = 0  # Samples written since creation
+
+    def append(self, t, temperature, humidity):
+        i = self.count % self.capacity
+        self.time[i] = t
+        self.temperature[i] = temperature
+        self.humidity[i] = humidity
+        self.count += 1
+
+    def since(self, count):
+        """
+        Returns (time, temperature, humidity) arrays of the samples written
+        after the first 'count' samples, at most 'capacity' latest ones.
+        """
+        first = max(count, self.count - self.capacity)
+        idx = np.arange(first, self.count) % self.capacity
+        return self.time[idx], self.temperature[idx], self.humidity[idx]
+
+
+class Sampler:
+    def __init__(self, read, rate=1.0, capacity=3600, on_sample=None):
+        # read() returns (humidity, temperature) like Si7021.read
+        self.read = read
+        self.period = 1 / rate
+        self.on_sample = on_sample
+
+        self.buffer = RingBuffer(capacity)
+        self._lock = threading.Lock()
+        self._cursor = 0  # buffer.count at the previous aggregate()
+        self._stop = threading.Event()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._worker.start()
+
+    def stop(self):
+        self._stop.set()
+        self._worker.join()
+
+    def _run(self):
+        deadline = time.monotonic()
+        while not self._stop.is_set():
+            # A failing read or handler only loses its own sample
+            try:
+                hum, temp = self.read()
+            except Exception as e:
+                print('reading sensor failed:', e)
+            else:
+                t = time.time()
+                with self._lock:
+                    self.buffer.append(t, temp, hum)
+                if self.on_sample is not None:
+                    try:
+                        self.on_sample(t, hum, temp)
+                    except Exception as e:
+                        print('handling sample failed:', e)
+
+            # Fixed rate: the next read is scheduled from the previous
+            # deadline, not from the end of a slow read
+            deadline = max(deadline + self.period, time.monotonic())
+            self._stop.wait(deadline - time.monotonic())
+
+    def aggregate(self):
+        """
+        Returns {'count': n, 'temperature': (mean, min, max),
+        'humidity': (mean, min, max)} of the samples taken since the
+        previous call or None if there are none.
+        """
+        with self._lock:
+            _, temps, hums = self.buffer.since(self._cursor)
+            self._cursor = self.buffer.count
+
+        if not len(temps):
+            return None
+        return {'count': len(temps),
+                'temperature': (float(temps.mean()), float(temps.min()),
+                                float(temps.max())),
+                'humidity': (float(hums.mean()), float(hums.min()),
+                             float(hums.max()))}
@@ -0,0 +1,387 @@
+import gzip
+import http.server
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import sms_pdu
+
+
+"""
+Simulated SIM800 modem and stand-in upload server for trying out the
+communication and the uploads without the hardware.
+
+SimulatedModem has the part of the serial.Serial interface used by gsm.GSM
+and answers the AT commands used by it: SMS in text and PDU mode, new
+message notifications, the GPRS bearer and HTTP POST. The HTTP requests
+are made for real with urllib, so they can be sent to an UploadServer.
+
+UploadServer is a local HTTP server which stores the uploaded records.
+Batches are keyed by (logger, file, record offset), so a batch sent again
+after a lost reply is stored only once.
+
+Usage:
+
+    server = UploadServer()
+    modem = SimulatedModem()
+    communication = Communication(gsm=GSM(ser=modem))
+    modem.deliver('+358...', 'stats')
+    uploader = Uploader('log_data', server.url, ModemTransport(communication,
+                                                               'internet'))
+    uploader.upload_pending()
+    print(len(server.records()))
+"""
+
+
+STATUS_CODES = {'REC UNREAD': 0, 'REC READ': 1}
+
+
+def deliver_pdu(number, text):
+    """
+    Returns (pdu, length) of an SMS-DELIVER of 'text' from 'number'
+    (a phone number or a sender name) as listed by the modem.
+    """
+    if number.lstrip('+').isdigit():
+        address = sms_pdu.encode_address(number)
+    else:
+        septets = sms_pdu.to_septets(number)
+        address = bytes([(len(septets) * 7 + 3) // 4, 0xD0]) + \
+            sms_pdu.pack_septets(septets)
+
+    if sms_pdu.is_gsm7(text):
+        septets = sms_pdu.to_septets(text)
+        dcs, udl = sms_pdu.DCS_GSM7, len(septets)
+        user_data = sms_pdu.pack_septets(septets)
+    else:
+        user_data = text.encode('utf-16-be')
+        dcs, udl = sms_pdu.DCS_UCS2, len(user_data)
+
+    # Service center time 22/11/30 12:00:00 +02:00 in swapped semi-octets
+    timestamp = bytes([0x22, 0x11, 0x03, 0x21, 0x00, 0x00, 0x80])
+    tpdu = bytes([0x04]) + address + bytes([0x00, dcs]) + timestamp + \
+        bytes([udl]) + user_data
+    # No service center address
+    return '00' + tpdu.hex().upper(), len(tpdu)
+
+
+class SimulatedModem:
+    def __init__(self, timeout=0.1):
+        self.timeout = timeout
+        # 'fail_sends' next SMS and 'fail_posts' next HTTP requests fail
+        self.fail_sends = 0
+        self.fail_posts = 0
+        # Seconds the modem takes to send an SMS
+        self.send_delay = 0
+
+        # Received messages {index: [status, number, text]}
+        self.stored = {}
+        # Sent messages [(length, PDU or text)]
+        self.sent = []
+
+        self._output = bytearray()
+        self._input = b''
+        self._cond = threading.Condition()
+        self._echo = True
+        self._pdu_mode = False
+        self._notify = False
+        self._sms_length = None  # Waiting for the text of AT+CMGS
+        self._bearer = {}
+        self._bearer_open = False
+        self._http = None  # HTTP session parameters
+        self._http_length = None  # Waiting for the data of AT+HTTPDATA
+
+    # The serial.Serial interface
+
+    @property
+    def in_waiting(self):
+        return len(self._output)
+
+    def flushInput(self):
+        with self._cond:
+            self._output.clear()
+
+    def read(self, size=1):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while not self._output and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            data = bytes(self._output[:size])
+            del self._output[:size]
+        return data
+
+    def write(self, data):
+        self._input += data
+        while self._input:
+            if self._http_length is not None:
+                if len(self._input) < self._http_length:
+                    break
+                self._http['data'] = self._input[:self._http_length]
+                self._input = self._input[self._http_length:]
+                self._http_length = None
+                self._emit('\r\nOK\r\n')
+            elif self._sms_length is not None:
+                if not any(c in self._input for c in b'\x1a\x1b'):
+                    break
+                end = min(self._input.find(c) for c in b'\x1a\x1b'
+                          if c in self._input)
+                self._send_sms(self._input[:end], self._input[end])
+                self._input = self._input[end + 1:]
+            elif b'\r' in self._input:
+                line, self._input = self._input.split(b'\r', 1)
+                self._command(line.decode().strip())
+            else:
+                break
+        return len(data)
+
+    # Simulation
+
+    def deliver(self, number, text):
+        """
+        Stores a received message, returns its index.
+        """
+        index = 1
+        while index in self.stored:
+            index += 1
+        self.stored[index] = ['REC UNREAD', number, text]
+        if self._notify:
+            self._emit(f'\r\n+CMTI: "SM",{index}\r\n')
+        return index
+
+    def _emit(self, text):
+        with self._cond:
+            self._output += text.encode()
+            self._cond.notify_all()
+
+    def _send_sms(self, text, end):
+        length, self._sms_length = self._sms_length, None
+        if end != 0x1a:
+            # Cancelled with ESC
+            return
+        if self.fail_sends:
+            self.fail_sends -= 1
+            self._emit('\r\n+CMS ERROR: 500\r\n')
+            return
+        time.sleep(self.send_delay)
+        self.sent.append((length, text.decode()))
+        self._emit(f'\r\n+CMGS: {len(self.sent)}\r\n\r\nOK\r\n')
+
+    def _command(self, line):
+        if self._echo:
+            self._emit(line + '\r\n')
+        if not line.upper().startswith('AT'):
+            return
+
+        response = ''
+        for cmd in line[2:].split(';'):
+            cmd = cmd.strip()
+            try:
+                result = self._execute(cmd)
+            except (KeyError, ValueError, IndexError):
+                self._emit('\r\nERROR\r\n')
+                return
+            if result is None:
+                # The command has sent its own response
+                return
+            response += result
+        self._emit(response + '\r\nOK\r\n')
+
+    # Returns the information lines of the response,
+    # None if the response has been sent already
+    def _execute(self, cmd):
+        name, _, args = cmd.partition('=')
+        args = [arg.strip('"') for arg in args.split(',')] if args else []
+
+        if name == 'E0':
+            self._echo = False
+        elif name == '':
+            pass
+        elif name == '+CMGF':
+            self._pdu_mode = args[0] == '0'
+        elif name == '+CNMI':
+            self._notify = True
+        elif name == '+CMGS':
+            self._sms_length = args[0]
+            self._emit('\r\n> ')
+            return None
+        elif name == '+CMGL':
+            return self._list_messages(args[0])
+        elif name == '+CMGR':
+            status, number, text = self.stored[int(args[0])]
+            self.stored[int(args[0])][0] = 'REC READ'
+            if self._pdu_mode:
+                pdu, length = deliver_pdu(number, text)
+                return f'\r\n+CMGR: {STATUS_CODES[status]},,{length}\r\n' \
+                    f'{pdu}\r\n'
+            return f'\r\n+CMGR: "{status}","{number}","",' \
+                f'"22/11/30,12:00:00+08"\r\n{text}\r\n'
+        elif name == '+CMGD':
+            if len(args) > 1 and args[1] == '4':
+                self.stored.clear()
+            else:
+                self.stored.pop(int(args[0]), None)
+        elif name == '+SAPBR':
+            return self._bearer_command(args)
+        elif name.startswith('+HTTP'):
+            return self._http_command(name, cmd, args)
+        else:
+            raise ValueError(cmd)
+        return ''
+
+    def _list_messages(self, status):
+        response = ''
+        for index, message in sorted(self.stored.items()):
+            if self._pdu_mode:
+                if status not in ('4', str(STATUS_CODES[message[0]])):
+                    continue
+                pdu, length = deliver_pdu(message[1], message[2])
+                response += f'\r\n+CMGL: {index},' \
+                    f'{STATUS_CODES[message[0]]},,{length}\r\n{pdu}'
+            elif status in ('ALL', message[0]):
+                response += f'\r\n+CMGL: {index},"{message[0]}",' \
+                    f'"{message[1]}","","22/11/30,12:00:00+08"\r\n' \
+                    f'{message[2]}\r\n'
+            else:
+                continue
+            message[0] = 'REC READ'
+        return response + ('\r\n' if self._pdu_mode and response else '')
+
+    def _bearer_command(self, args):
+        mode, cid = args[0], args[1]
+        if mode == '3':
+            self._bearer[args[2]] = args[3]
+        elif mode == '2':
+            return f'\r\n+SAPBR: {cid},{1 if self._bearer_open else 3},' \
+                f'"10.0.0.2"\r\n'
+        elif mode == '1':
+            if not self._bearer.get('APN'):
+                raise ValueError('no APN')
+            self._bearer_open = True
+        elif mode == '0':
+            self._bearer_open = False
+        return ''
+
+    def _http_command(self, name, cmd, args):
+        if name == '+HTTPINIT':
+            if self._http is not None:
+                raise ValueError('HTTP session open')
+            self._http = {}
+        elif name == '+HTTPTERM':
+            if self._http is None:
+                raise ValueError('no HTTP session')
+            self._http = None
+        elif name == '+HTTPPARA':
+            # The value may contain commas
+            key, value = cmd.split('=', 1)[1].split(',', 1)
+            self._http[key.strip('"')] = value.strip('"')
+        elif name == '+HTTPDATA':
+            self._http['data'] = b''
+            self._http_length = int(args[0])
+            self._emit('\r\nDOWNLOAD\r\n')
+            return None
+        elif name == '+HTTPACTION':
+            if args[0] != '1' or not self._bearer_open:
+                raise ValueError(cmd)
+            session = self._http
+            threading.Thread(target=self._http_post, args=(session,),
+                             daemon=True).start()
+        else:
+            raise ValueError(cmd)
+        return ''
+
+    def _http_post(self, session):
+        headers = {'Content-Type': session.get('CONTENT',
+                                               'application/octet-stream')}
+        for header in session.get('USERDATA', '').split('\\r\\n'):
+            key, sep, value = header.partition(':')
+            if sep:
+                headers[key.strip()] = value.strip()
+
+        if self.fail_posts:
+            self.fail_posts -= 1
+            # Network error
+            self._emit('\r\n+HTTPACTION: 1,601,0\r\n')
+            return
+
+        request = urllib.request.Request(session['URL'], method='POST',
+                                         data=session.get('data', b''),
+                                         headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=30) as r:
+                status, length = r.status, len(r.read())
+        except urllib.error.HTTPError as e:
+            status, length = e.code, 0
+        except OSError:
+            status, length = 601, 0
+        self._emit(f'\r\n+HTTPACTION: 1,{status},{length}\r\n')
+
+
+class UploadServer:
+    def __init__(self, host='127.0.0.1', port=0):
+        """
+        Starts the server in a background thread, port 0 picks a free one.
+        """
+        # {(logger, file, offset): [(time, temperature, humidity)]}
+        self.batches = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                data = self.rfile.read(int(self.headers['Content-Length']))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    data = gzip.decompress(data)
+                records = [tuple(float(v) for v in line.split('\t'))
+                           for line in data.decode().splitlines()]
+                key = (self.headers.get('X-Logger'),
+                       self.headers.get('X-Log-File'),
+                       int(self.headers.get('X-Record-Offset', 0)))
+                with server._lock:
+                    server.requests += 1
+                    server.batches.setdefault(key, records)
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.url = f'http://{host}:{self._server.server_port}/upload'
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+
+    def records(self, logger=None):
+        """
+        Returns the received records in (logger, file, offset) order.
+        """
+        with self._lock:
+            return [record for key, batch in sorted(self.batches.items())
+                    if logger in (None, key[0]) for record in batch]
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == '__main__':
+
+    from communication import Communication
+    from gsm import GSM
+    from uploader import ModemTransport, Uploader
+
+    server = UploadServer()
+    modem = SimulatedModem()
+    communication = Communication(gsm=GSM(ser=modem))
+    modem.deliver('+000000000', 'help')
+
+    uploader = Uploader('./log_data', server.url,
+                        ModemTransport(communication, apn='internet'),
+                        checkpoint_fpath='./log_data/upload_demo.json')
+    print('uploaded records:', uploader.upload_pending())
+    print('records on the server:', len(server.records()))
+    print('tasks:', communication.get_tasks())
+
+    communication.stop()
+    server.close()
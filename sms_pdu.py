@@ -0,0 +1,313 @@
+"""
+SMS-SUBMIT PDU encoding for sending long messages as concatenated SMS
+and SMS-DELIVER PDU decoding for reading received messages.
+
+Reference: 3GPP TS 23.038 (alphabets) and TS 23.040 (PDU format)
+
+Usage:
+
+    for pdu, length in encode_submit('+358401234567', pack_message(text), ref=1):
+        # AT+CMGS=<length> followed by the PDU in hex
+        ...
+
+Messages which fit in the GSM 7-bit default alphabet use 160 characters
+per single SMS and 153 per part of a concatenated message. Other messages
+are sent in UCS-2 with 70 and 67 characters.
+
+Received messages are read in PDU mode (AT+CMGF=0), where the message is
+one line of hex digits, so no message text can be mistaken for a result
+code:
+
+    number, date, mtime, text = decode_deliver(pdu)
+"""
+
+
+# GSM 7-bit default alphabet, the index of a character is its septet value
+GSM7_BASIC = (
+    '@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+    '¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà'
+)
+# Characters of the extension table, sent as escape + septet
+GSM7_EXTENSION = {'\f': 0x0A, '^': 0x14, '{': 0x28, '}': 0x29, '\\': 0x2F,
+                  '[': 0x3C, '~': 0x3D, ']': 0x3E, '|': 0x40, '€': 0x65}
+GSM7_ESCAPE = 0x1B
+
+_GSM7_INDEX = {c: i for i, c in enumerate(GSM7_BASIC)}
+_GSM7_EXTENSION_CHARS = {septet: c for c, septet in GSM7_EXTENSION.items()}
+
+# Common characters that force UCS-2 but have a close GSM 7-bit equivalent
+GSM7_REPLACEMENTS = {'‘': "'", '’': "'", '´': "'", '`': "'",
+                     '“': '"', '”': '"', '–': '-', '—': '-',
+                     '…': '...', '\t': ' ', '\u00a0': ' ', '°': ''}
+
+# Maximum characters (septets or UCS-2 code units) per message
+GSM7_SINGLE = 160
+GSM7_PART = 153
+UCS2_SINGLE = 70
+UCS2_PART = 67
+
+# Data coding schemes
+DCS_GSM7 = 0x00
+DCS_UCS2 = 0x08
+
+# Alphabets of received messages
+ALPHABET_GSM7 = 0
+ALPHABET_8BIT = 1
+ALPHABET_UCS2 = 2
+
+# Type of address of alphanumeric sender names
+TON_ALPHANUMERIC = 0x50
+
+
+def is_gsm7(text):
+    return all(c in _GSM7_INDEX or c in GSM7_EXTENSION for c in text)
+
+
+def to_septets(text):
+    septets = []
+    for c in text:
+        if c in _GSM7_INDEX:
+            septets.append(_GSM7_INDEX[c])
+        else:
+            septets += [GSM7_ESCAPE, GSM7_EXTENSION[c]]
+    return septets
+
+
+def split_message(text):
+    """
+    Splits 'text' into the parts of a concatenated message.
+
+    Returns (dcs, parts) where each part is a list of septets (GSM 7-bit)
+    or a string (UCS-2). Escape sequences and surrogate pairs are never
+    split between two parts.
+    """
+    if is_gsm7(text):
+        units = [to_septets(c) for c in text]
+        dcs, single, part_size = DCS_GSM7, GSM7_SINGLE, GSM7_PART
+    else:
+        units = [c.encode('utf-16-be') for c in text]
+        dcs, single, part_size = DCS_UCS2, UCS2_SINGLE * 2, UCS2_PART * 2
+
+    if sum(len(u) for u in units) <= single:
+        parts = [units]
+    else:
+        parts = [[]]
+        used = 0
+        for unit in units:
+            if used + len(unit) > part_size:
+                parts.append([])
+                used = 0
+            parts[-1].append(unit)
+            used += len(unit)
+
+    if dcs == DCS_GSM7:
+        return dcs, [[s for unit in part for s in unit] for part in parts]
+    return dcs, [b''.join(part).decode('utf-16-be') for part in parts]
+
+
+def count_parts(text):
+    return len(split_message(text)[1])
+
+
+def pack_message(text):
+    """
+    Prepares a reply for sending in as few parts as possible.
+
+    Characters with a GSM 7-bit equivalent are replaced so that the
+    message is not sent in UCS-2 and trailing whitespace is removed.
+    Empty lines are removed only if that saves a part.
+    """
+    for c, replacement in GSM7_REPLACEMENTS.items():
+        text = text.replace(c, replacement)
+
+    text = '\n'.join(line.rstrip() for line in text.strip().split('\n'))
+    compact = '\n'.join(line for line in text.split('\n') if line)
+    if count_parts(compact) < count_parts(text):
+        return compact
+    return text
+
+
+def pack_septets(septets, fill_bits=0):
+    """
+    Packs 7-bit values into octets, starting after 'fill_bits' zero bits.
+    """
+    octets = bytearray()
+    acc = 0
+    nbits = fill_bits
+    for septet in septets:
+        acc |= septet << nbits
+        nbits += 7
+        while nbits >= 8:
+            octets.append(acc & 0xFF)
+            acc >>= 8
+            nbits -= 8
+    if nbits > 0:
+        octets.append(acc & 0xFF)
+    return bytes(octets)
+
+
+def encode_address(number):
+    """
+    Encodes an international (+...) or national phone number. Raises
+    ValueError for other addresses such as alphanumeric sender names,
+    which cannot be replied to.
+    """
+    digits = number[1:] if number.startswith('+') else number
+    if not digits or not digits.isascii() or not digits.isdigit():
+        raise ValueError(f'not a phone number: {number!r}')
+    type_of_address = 0x91 if number.startswith('+') else 0x81
+    padded = digits + 'F' * (len(digits) % 2)
+    swapped = ''.join(padded[i + 1] + padded[i]
+                      for i in range(0, len(padded), 2))
+    return bytes([len(digits), type_of_address]) + bytes.fromhex(swapped)
+
+
+def encode_submit(number, text, ref=0):
+    """
+    Returns a list of (pdu, length) tuples for sending 'text' to 'number'.
+
+    'pdu' is the hex string written after AT+CMGS=<length> in PDU mode
+    and 'length' the TPDU length in octets. 'ref' identifies the parts
+    of the same concatenated message and should change between messages.
+    """
+    dcs, parts = split_message(text)
+    total = len(parts)
+
+    pdus = []
+    for seq, part in enumerate(parts, 1):
+        if total > 1:
+            # Concatenated SMS information element with 8-bit reference
+            udh = bytes([5, 0x00, 3, ref & 0xFF, total, seq])
+        else:
+            udh = b''
+
+        if dcs == DCS_GSM7:
+            # User data continues at the next septet boundary after the header
+            fill_bits = (7 - len(udh) * 8 % 7) % 7
+            header_septets = (len(udh) * 8 + fill_bits) // 7
+            user_data = udh + pack_septets(part, fill_bits)
+            udl = header_septets + len(part)
+        else:
+            user_data = udh + part.encode('utf-16-be')
+            udl = len(user_data)
+
+        first_octet = 0x01 | (0x40 if udh else 0x00)  # SMS-SUBMIT, UDHI
+        tpdu = bytes([first_octet, 0x00]) + encode_address(number) + \
+            bytes([0x00, dcs, udl]) + user_data
+
+        # Empty service center address: use the one stored on the SIM card
+        pdus.append(('00' + tpdu.hex().upper(), len(tpdu)))
+    return pdus
+
+
+def unpack_septets(octets, count):
+    """
+    Unpacks 'count' 7-bit values from packed octets.
+    """
+    septets = []
+    acc = 0
+    nbits = 0
+    for octet in octets:
+        acc |= octet << nbits
+        nbits += 8
+        while nbits >= 7 and len(septets) < count:
+            septets.append(acc & 0x7F)
+            acc >>= 7
+            nbits -= 7
+    return septets
+
+
+def from_septets(septets):
+    chars = []
+    escape = False
+    for septet in septets:
+        if escape:
+            chars.append(_GSM7_EXTENSION_CHARS.get(septet, ' '))
+            escape = False
+        elif septet == GSM7_ESCAPE:
+            escape = True
+        else:
+            chars.append(GSM7_BASIC[septet])
+    return ''.join(chars)
+
+
+def _semi_octets(octets):
+    # Swapped BCD digits, 'F' is filler
+    return ''.join(f'{o & 0x0F:X}{o >> 4:X}' for o in octets).rstrip('F')
+
+
+def decode_address(length, type_of_address, octets):
+    """
+    Decodes an address of 'length' semi-octets (digits).
+    """
+    if type_of_address & 0x70 == TON_ALPHANUMERIC:
+        return from_septets(unpack_septets(octets, length * 4 // 7))
+    digits = _semi_octets(octets)
+    return '+' + digits if type_of_address & 0x70 == 0x10 else digits
+
+
+def _alphabet(dcs):
+    if dcs & 0xC0 == 0x00:
+        # General data coding
+        return (dcs >> 2) & 0x03
+    if dcs & 0xF0 == 0xF0:
+        return ALPHABET_8BIT if dcs & 0x04 else ALPHABET_GSM7
+    if dcs & 0xF0 == 0xE0:
+        return ALPHABET_UCS2
+    return ALPHABET_GSM7
+
+
+def decode_deliver(pdu):
+    """
+    Decodes an SMS-DELIVER PDU in hex as listed by the modem (with the
+    service center address) into (number, date, mtime, text).
+
+    'date' is yy/MM/dd and 'mtime' hh:mm:ss+zz like in text mode. The
+    user data header of a concatenated message part is skipped, every
+    part is returned as its own message. Raises ValueError if the PDU is
+    malformed.
+    """
+    try:
+        data = bytes.fromhex(pdu.strip())
+        i = data[0] + 1  # Service center address
+        first_octet = data[i]
+        length, type_of_address = data[i + 1], data[i + 2]
+        i += 3
+        number = decode_address(length, type_of_address,
+                                data[i:i + (length + 1) // 2])
+        i += (length + 1) // 2
+
+        dcs = data[i + 1]
+        timestamp = _semi_octets(data[i + 2:i + 8])
+        zone = data[i + 8]
+        i += 9
+        udl = data[i]
+        user_data = data[i + 1:]
+    except IndexError:
+        raise ValueError(f'truncated PDU: {pdu}')
+
+    # Time zone in quarters of an hour, bit 3 is the sign
+    quarters = (zone & 0x07) * 10 + (zone >> 4)
+    sign = '-' if zone & 0x08 else '+'
+    date = f'{timestamp[0:2]}/{timestamp[2:4]}/{timestamp[4:6]}'
+    mtime = f'{timestamp[6:8]}:{timestamp[8:10]}:{timestamp[10:12]}' \
+        f'{sign}{quarters:02d}'
+
+    header_length = user_data[0] + 1 if first_octet & 0x40 and user_data \
+        else 0
+    alphabet = _alphabet(dcs)
+    if alphabet == ALPHABET_GSM7:
+        septets = unpack_septets(user_data, udl)
+        if len(septets) < udl:
+            raise ValueError(f'truncated PDU: {pdu}')
+        # Text starts at the septet boundary after the header
+        text = from_septets(septets[(header_length * 8 + 6) // 7:])
+    else:
+        if len(user_data) < udl:
+            raise ValueError(f'truncated PDU: {pdu}')
+        body = user_data[header_length:udl]
+        if alphabet == ALPHABET_UCS2:
+            text = body.decode('utf-16-be', errors='replace')
+        else:
+            text = body.decode('latin-1')
+    return number, date, mtime, text
@@ -0,0 +1,37 @@
+import json
+import os
+
+
+"""
+Atomic JSON snapshots for warm starts.
+
+The snapshot is written to a temporary file, forced to disk and renamed
+over the previous snapshot, so a crash leaves either the old or the new
+snapshot but never a partial one.
+
+Usage:
+
+    save_snapshot('log_data/logger_state.json', {'alarm_state': ...})
+    state = load_snapshot('log_data/logger_state.json') or {}
+"""
+
+
+def save_snapshot(fpath, data):
+    tmp_fpath = fpath + '.tmp'
+    with open(tmp_fpath, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fpath, fpath)
+
+
+def load_snapshot(fpath):
+    """
+    Returns the saved snapshot or None if there is no valid snapshot.
+    """
+    try:
+        with open(fpath, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return data if isinstance(data, dict) else None
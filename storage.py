@@ -0,0 +1,256 @@
+import os
+import sqlite3
+import threading
+import time
+
+from binary_log import BinaryLogWriter
+from history import LogIndex, Summary
+from log_writer import LogWriter
+import metrics
+
+
+"""
+Storage backends for the sensor readings.
+
+Every backend has the same interface:
+
+    open(timestamp, append)  - start a new log run, returns the closed files
+    write_sample(dt, temperature, humidity)
+    write_event(dt, kind, detail)  - for example ('profile', 'milk')
+    flush(), flush_expired(), close()
+    query(start, end)        - Summary of the samples between epoch times
+
+FileStore keeps the log file per run layout (text and/or binary files,
+see log_writer and binary_log). SqliteStore keeps all readings and
+events in one SQLite database in WAL mode with a time index, so time
+range queries do not depend on how many runs the data spans.
+
+Usage:
+
+    store = SqliteStore('log_data/readings.db')
+    store.write_sample(datetime.now(), 4.2, 80.1)
+    since, _, _ = store.last_event('profile')
+    print(store.query(since, time.time()).humidity_max)
+"""
+
+
+class FileStore:
+    def __init__(self, directory, text=True, binary=False, compressor=None,
+                 **buffering):
+        """
+        'buffering' is passed to the log writers (flush_count,
+        flush_seconds, fsync). Closed files are given to 'compressor'.
+        """
+        self.directory = directory
+        self.text = text
+        self.binary = binary
+        self.compressor = compressor
+        self.buffering = buffering
+
+        self.text_writer = None
+        self.binary_writer = None
+        # Time range queries over the log files
+        self.index = LogIndex(directory)
+
+    @property
+    def fpath(self):
+        """
+        Path of the main log file of the current run.
+        """
+        writer = self.text_writer or self.binary_writer
+        return writer.fpath if writer is not None else None
+
+    def fpaths(self):
+        return [writer.fpath for writer in self._writers()]
+
+    def _writers(self):
+        return [writer for writer in (self.text_writer, self.binary_writer)
+                if writer is not None]
+
+    def open(self, timestamp, append=False):
+        """
+        Starts the files <timestamp>.txt and/or .bin, continuing them if
+        'append' is set and they exist.
+        """
+        fpath = os.path.join(self.directory, timestamp)
+
+        closed = self.fpaths()
+        self.close()
+        if self.compressor is not None:
+            for closed_fpath in closed:
+                self.compressor.submit(closed_fpath)
+
+        if self.text:
+            if append and os.path.exists(fpath + '.txt'):
+                self.text_writer = LogWriter(fpath + '.txt', mode='a',
+                                             **self.buffering)
+            else:
+                self.text_writer = LogWriter(
+                    fpath + '.txt', header='time\ttemperature\thumidity\n',
+                    **self.buffering)
+
+        if self.binary:
+            self.binary_writer = BinaryLogWriter(
+                fpath + '.bin',
+                append=append and os.path.exists(fpath + '.bin'),
+                **self.buffering)
+        return closed
+
+    def write_sample(self, dt, temperature, humidity):
+        if self.text_writer is not None:
+            timestamp = dt.strftime('%Y%m%d_%H%M%S')
+            self.text_writer.write(
+                f'{timestamp}\t{round(temperature, 2)}\t{round(humidity, 2)}\n')
+        if self.binary_writer is not None:
+            self.binary_writer.write_sample(dt.timestamp(), temperature,
+                                            humidity)
+
+    # Events are not stored in the log files
+    def write_event(self, dt, kind, detail):
+        pass
+
+    def flush(self):
+        for writer in self._writers():
+            writer.flush()
+
+    def flush_expired(self):
+        for writer in self._writers():
+            writer.flush_expired()
+
+    def close(self):
+        for writer in self._writers():
+            writer.close()
+
+    def query(self, start, end):
+        self.flush()
+        return self.index.query(start, end)
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS samples (
+    time REAL NOT NULL,
+    temperature REAL NOT NULL,
+    humidity REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_time ON samples (time);
+CREATE TABLE IF NOT EXISTS events (
+    time REAL NOT NULL,
+    kind TEXT NOT NULL,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (kind, time);
+'''
+
+
+class SqliteStore:
+    def __init__(self, fpath, flush_count=10, flush_seconds=300):
+        """
+        Samples and events are inserted as one transaction when
+        'flush_count' are waiting or the oldest is 'flush_seconds' old.
+        """
+        self.fpath = fpath
+        self.flush_count = max(1, flush_count)
+        self.flush_seconds = flush_seconds
+
+        # Written by the logging and the sampler threads
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(fpath, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(_SCHEMA)
+
+        self._samples = []
+        self._events = []
+        self._oldest = None  # time.monotonic() of the oldest pending row
+
+    # The database is not split into runs
+    def open(self, timestamp, append=False):
+        return []
+
+    def _add(self, rows, row):
+        with self._lock:
+            if not self._samples and not self._events:
+                self._oldest = time.monotonic()
+            rows.append(row)
+            full = len(self._samples) + len(self._events) >= self.flush_count
+        if full or self._expired():
+            self.flush()
+
+    def write_sample(self, dt, temperature, humidity):
+        self._add(self._samples, (dt.timestamp(), temperature, humidity))
+
+    def write_event(self, dt, kind, detail):
+        self._add(self._events, (dt.timestamp(), kind, detail))
+
+    def _expired(self):
+        return self._oldest is not None and \
+            time.monotonic() - self._oldest >= self.flush_seconds
+
+    def flush_expired(self):
+        if self._expired():
+            self.flush()
+
+    def flush(self):
+        with self._lock, metrics.timer('sqlite_commit_seconds'):
+            if not self._samples and not self._events:
+                return
+            with self._db:
+                self._db.execute('BEGIN')
+                self._db.executemany('INSERT INTO samples VALUES (?, ?, ?)',
+                                     self._samples)
+                self._db.executemany('INSERT INTO events VALUES (?, ?, ?)',
+                                     self._events)
+            self._samples = []
+            self._events = []
+            self._oldest = None
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._db.close()
+
+    def query(self, start, end):
+        self.flush()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT COUNT(*), MIN(time), MAX(time), '
+                'MIN(temperature), MAX(temperature), TOTAL(temperature), '
+                'MIN(humidity), MAX(humidity), TOTAL(humidity) '
+                'FROM samples WHERE time BETWEEN ? AND ?',
+                (start, end)).fetchone()
+        return Summary(*row) if row[0] else Summary()
+
+    def samples(self, start, end):
+        """
+        Returns [(time, temperature, humidity)] between epoch times
+        'start' and 'end' in time order.
+        """
+        self.flush()
+        with self._lock:
+            return self._db.execute(
+                'SELECT time, temperature, humidity FROM samples '
+                'WHERE time BETWEEN ? AND ? ORDER BY time',
+                (start, end)).fetchall()
+
+    def events(self, kind, start=0, end=float('inf')):
+        """
+        Returns [(time, kind, detail)] of the events of 'kind' between
+        epoch times 'start' and 'end' in time order.
+        """
+        self.flush()
+        with self._lock:
+            return self._db.execute(
+                'SELECT time, kind, detail FROM events '
+                'WHERE kind = ? AND time BETWEEN ? AND ? ORDER BY time',
+                (kind, start, end)).fetchall()
+
+    def last_event(self, kind):
+        """
+        Returns the latest (time, kind, detail) of 'kind' or None.
+        """
+        self.flush()
+        with self._lock:
+            return self._db.execute(
+                'SELECT time, kind, detail FROM events WHERE kind = ? '
+                'ORDER BY time DESC LIMIT 1', (kind,)).fetchone()
@@ -33,11 +33,20 @@ class TASK_TYPE(Enum):
     # number
     HELP = 10
 
-    # _
+    # number
     RESTART = 11
 
+    # number, start, end
+    SEND_HISTORY = 13
+
+    # number
+    SEND_STATS = 14
+
+    # number
+    RELOAD_SETTINGS = 15
+
 
     # DataLogger
 
-    # numbers, variable, type
+    # numbers, events [(variable, type, value, since)]
     SEND_ALARM = 12
@@ -0,0 +1,183 @@
+import gzip
+import itertools
+import os
+import threading
+import urllib.error
+import urllib.request
+
+from compression import iter_records, uncompressed_name
+from gsm import GSMError
+from history import log_files
+from snapshot import load_snapshot, save_snapshot
+import metrics
+
+
+"""
+Bulk upload of the log files over HTTP.
+
+New records of the log files are sent in batches as gzip compressed
+TSV (epoch time, temperature, humidity) with HTTP POST. The number of
+records of each file accepted by the server is kept in a checkpoint
+file, saved after every batch, so an interrupted upload continues from
+the first record not yet accepted. Every request carries the file name
+and the offset of its first record (X-Log-File, X-Record-Offset), so
+the server can drop a batch it already has if the reply to it was lost.
+
+ModemTransport sends over the GPRS connection of the modem, between the
+SMS messages handled by Communication. HttpTransport uses the network
+connection of the host.
+
+Usage:
+
+    transport = ModemTransport(communication, apn='internet')
+    uploader = Uploader('log_data', 'http://example.com/upload', transport)
+    uploader.start()
+"""
+
+
+class ModemTransport:
+    def __init__(self, communication, apn, timeout=120):
+        self.communication = communication
+        self.apn = apn
+        self.timeout = timeout
+
+    def post(self, url, data, headers):
+        """
+        Returns the HTTP status code. Raises GSMError on failure.
+        """
+        def job(gsm):
+            gsm.open_bearer(self.apn)
+            return gsm.http_post(url, data, headers=headers,
+                                 timeout=self.timeout)
+
+        future = self.communication.run_on_modem(job)
+        return future.result()
+
+
+class HttpTransport:
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+
+    def post(self, url, data, headers):
+        """
+        Returns the HTTP status code. Raises OSError on failure.
+        """
+        request = urllib.request.Request(
+            url, data=data, method='POST',
+            headers=dict(headers, **{'Content-Type':
+                                     'application/octet-stream'}))
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as r:
+                return r.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+class Uploader:
+    def __init__(self, directory, url, transport, checkpoint_fpath=None,
+                 batch_records=500, interval=600, name=None):
+        """
+        Uploads the log files of 'directory' to 'url' every 'interval'
+        seconds, at most 'batch_records' records per request. 'name' is
+        sent in the X-Logger header.
+        """
+        self.directory = directory
+        self.url = url
+        self.transport = transport
+        self.checkpoint_fpath = checkpoint_fpath or \
+            os.path.join(directory, 'upload_checkpoint.json')
+        self.batch_records = max(1, batch_records)
+        self.interval = interval
+        self.name = name or os.path.basename(os.path.abspath(directory))
+
+        # 'files': {file name: records uploaded}
+        # 'done': names of the compressed files uploaded completely
+        checkpoint = load_snapshot(self.checkpoint_fpath) or {}
+        self.uploaded = checkpoint.get('files', {})
+        self.done = set(checkpoint.get('done', []))
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.upload_pending()
+            self._stop.wait(self.interval)
+
+    def _save_checkpoint(self):
+        save_snapshot(self.checkpoint_fpath,
+                      {'files': self.uploaded, 'done': sorted(self.done)})
+
+    def upload_pending(self):
+        """
+        Uploads the records not yet uploaded. Stops at the first failed
+        request, the rest is uploaded on the next call. Returns the number
+        of records uploaded.
+        """
+        text, binary = log_files(self.directory)
+        count = 0
+        for fpath in sorted(text + binary):
+            name = os.path.basename(uncompressed_name(fpath))
+            if name in self.done:
+                continue
+            try:
+                uploaded = self._upload_file(fpath, name)
+            except (OSError, GSMError) as e:
+                print('uploading', name, 'failed:', e)
+                metrics.inc('upload_errors_total')
+                return count
+            if uploaded is None:
+                return count
+            count += uploaded
+            if self._stop.is_set():
+                return count
+
+            if fpath != uncompressed_name(fpath):
+                # A compressed file does not grow any more
+                self.done.add(name)
+                self.uploaded.pop(name, None)
+                self._save_checkpoint()
+        return count
+
+    # Returns the number of records uploaded or None if the server
+    # did not accept a batch
+    def _upload_file(self, fpath, name):
+        offset = self.uploaded.get(name, 0)
+        records = itertools.islice(iter_records(fpath), offset, None)
+        count = 0
+        while not self._stop.is_set():
+            batch = list(itertools.islice(records, self.batch_records))
+            if not batch:
+                break
+
+            data = gzip.compress(''.join(
+                f'{t:.0f}\t{round(temp, 2)}\t{round(hum, 2)}\n'
+                for t, temp, hum in batch).encode())
+            headers = {'Content-Encoding': 'gzip',
+                       'X-Logger': self.name,
+                       'X-Log-File': name,
+                       'X-Record-Offset': offset}
+            with metrics.timer('upload_seconds'):
+                status = self.transport.post(self.url, data, headers)
+            if not 200 <= status < 300:
+                print('uploading', name, 'failed: HTTP status', status)
+                metrics.inc('upload_errors_total')
+                return None
+
+            offset += len(batch)
+            count += len(batch)
+            self.uploaded[name] = offset
+            self._save_checkpoint()
+            metrics.inc('upload_records_total', len(batch))
+            metrics.inc('upload_bytes_total', len(data))
+        return count